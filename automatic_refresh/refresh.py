@@ -30,41 +30,12 @@ from met.metadataparser.refresh_metadata import refresh
 
 django.setup()
 
-class SingleRun(object):
-    class InstanceRunningException(Exception):
-        pass
-
-    def __init__(self, lock_file):
-        #define the lock file name
-        self.lock_file =  "/tmp/%s.pid" % lock_file
-
-    def __call__(self, func):
-        def fnc(*args, **kwargs):
-            if os.path.exists(self.lock_file):
-                #get process id, if lock file exists
-                pid = open(self.lock_file, "rt").read()
-                if not os.path.exists("/proc/%s" % pid):
-                    #if process is not alive remove the lock file
-                    os.unlink(self.lock_file)
-                else:
-                    #process is running
-                    raise self.InstanceRunningException(pid)
-
-            try:
-                #store process id
-                open(self.lock_file, "wt").write(str(os.getpid()))
-                #execute wrapped function
-                func(*args,**kwargs)
-            finally:
-                if os.path.exists(self.lock_file):
-                    os.unlink(self.lock_file)
-        return fnc
-
 class RefreshMetaData(object):
     @classmethod
     def process(cls, options):
         fed_name = options.fed_name
         force_refresh = options.force_refresh
+        workers = options.workers
         
         logger = None
         if options.log:
@@ -72,15 +43,14 @@ class RefreshMetaData(object):
             logger = logging.getLogger("Refresh")
     
         try:
-            refresh(fed_name, force_refresh, logger)
+            refresh(fed_name, force_refresh, logger, workers)
         except Exception as e:
             if logger:
 	        logger.error("%s" % e)
 
-@SingleRun(lock_file="met-metadatarefresh")
 def commandline_call(convert_class=RefreshMetaData):
     opt_parser = OptionParser()
-    opt_parser.set_usage("refresh [--federation <fed_name>] [--log  <file>] [--force-refresh]")
+    opt_parser.set_usage("refresh [--federation <fed_name>] [--log  <file>] [--force-refresh] [--workers <num>]")
     
     opt_parser.add_option(
         "-l",
@@ -108,6 +78,15 @@ def commandline_call(convert_class=RefreshMetaData):
         help="Force refresh of metadata information (even if file has not changed)",
         metavar="REF")
 
+    opt_parser.add_option(
+        "-w",
+        "--workers",
+        type="int",
+        dest="workers",
+        help="Number of federations refreshed in parallel",
+        default=1,
+        metavar="WORKERS")
+
     (options, _) = opt_parser.parse_args()
     
     error_message = ""
@@ -0,0 +1,95 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Compare plain, gzip and xz storage of a large aggregate: size on disk,
+# wall time and bytes read to build the entity index, to walk every
+# entity and to read the last entity through the index.
+#
+#   python benchmark/compression_benchmark.py [--file <aggregate>] [--entities <num>]
+
+import sys, os
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+current_directory = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(current_directory)
+
+from met.metadataparser.compression import COMPRESSION_SUFFIXES, compress_file, lzma
+from met.metadataparser.entity_index import remove_index
+from met.metadataparser.xmlparser import MetadataParser
+from synthetic import write_aggregate
+
+
+def _read_bytes():
+    '''Bytes read by this process so far, as counted by the kernel'''
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(': ') for line in io.read().splitlines())
+        return int(counters['rchar'])
+    except (IOError, KeyError):
+        return 0
+
+
+def _measure(action):
+    start_bytes = _read_bytes()
+    start = time.time()
+    result = action()
+    return result, time.time() - start, _read_bytes() - start_bytes
+
+
+def run(filename, directory):
+    stored = [('plain', filename)]
+    for compression in sorted(COMPRESSION_SUFFIXES):
+        if compression == 'xz' and lzma is None:
+            print('Skipping xz, the backports.lzma package is not installed')
+            continue
+        compressed_name = os.path.join(directory, 'metadata.xml' + COMPRESSION_SUFFIXES[compression])
+        with open(filename, 'rb') as aggregate:
+            compress_file(aggregate, compressed_name, compression)
+        stored.append((compression, compressed_name))
+
+    print('%-6s %12s %10s %12s %10s %12s %10s %12s' % ('', 'size', 'index s', 'index read', 'walk s', 'walk read',
+                                                      'last s', 'last read'))
+    for name, stored_name in stored:
+        remove_index(stored_name)
+        parser = MetadataParser(filename=stored_name)
+        _, index_time, index_bytes = _measure(parser.prepare_index)
+        count, walk_time, walk_bytes = _measure(lambda: sum(1 for _ in parser.iter_entities(details=False)))
+        last = list(parser.index)[-1]
+        _, last_time, last_bytes = _measure(lambda: parser.get_entity_xml(last))
+        remove_index(stored_name)
+        print('%-6s %12d %10.2f %12d %10.2f %12d %10.3f %12d' % (name, os.path.getsize(stored_name), index_time,
+                                                               index_bytes, walk_time, walk_bytes, last_time,
+                                                               last_bytes))
+    print('%d entities' % count)
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.set_usage("compression_benchmark [--file <aggregate>] [--entities <num>]")
+    opt_parser.add_option("-f", "--file", type="string", dest="filename", default=None,
+                          help="The aggregate to use (a synthetic one is generated if missing)")
+    opt_parser.add_option("-e", "--entities", type="int", dest="entities", default=20000,
+                          help="Number of entities of the synthetic aggregate")
+    (options, _) = opt_parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = options.filename
+        if not filename:
+            filename = os.path.join(directory, 'metadata.xml')
+            write_aggregate(filename, options.entities)
+        run(filename, directory)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,91 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Compare the per-field XPath extractors of MetadataParser with the single
+# walk extractor on a large aggregate:
+#
+#   python benchmark/parser_benchmark.py [--file <aggregate>] [--entities <num>]
+
+import sys, os
+import time
+import tempfile
+from optparse import OptionParser
+
+current_directory = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(current_directory)
+
+from lxml import etree
+
+from met.metadataparser.xmlparser import MetadataParser, ENTITY_ROOT_TAG
+from synthetic import write_aggregate
+
+
+def _load_elements(filename):
+    elements = []
+    context = etree.iterparse(filename, tag=ENTITY_ROOT_TAG, events=('end',), huge_tree=True, remove_blank_text=True)
+    for _, element in context:
+        elements.append(element)
+    return elements
+
+
+def _time_extractor(extractor, elements, details, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for element in elements:
+            extractor(element, details)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(filename, repeat):
+    start = time.time()
+    elements = _load_elements(filename)
+    print('Parsed %d entities from %s (%d bytes) in %.3fs' %
+          (len(elements), filename, os.path.getsize(filename), time.time() - start))
+
+    for element in elements:
+        for details in (True, False):
+            if MetadataParser._walk_entity(element, details) != MetadataParser._get_entity_by_xpath(element, details):
+                raise ValueError('Extractors differ on %s' % element.get('entityID'))
+    print('Both extractors produce the same entities')
+
+    for details in (True, False):
+        xpath_time = _time_extractor(MetadataParser._get_entity_by_xpath, elements, details, repeat)
+        walk_time = _time_extractor(MetadataParser._walk_entity, elements, details, repeat)
+        print('details=%-5s  xpath %.3fs  walk %.3fs  speedup %.1fx' %
+              (details, xpath_time, walk_time, xpath_time / walk_time))
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.set_usage("parser_benchmark [--file <aggregate>] [--entities <num>] [--repeat <num>]")
+    opt_parser.add_option("-f", "--file", type="string", dest="filename", default=None,
+                          help="The aggregate to use (a synthetic one is generated if missing)")
+    opt_parser.add_option("-e", "--entities", type="int", dest="entities", default=8000,
+                          help="Number of entities of the synthetic aggregate")
+    opt_parser.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                          help="Number of runs, the best one is reported")
+    (options, _) = opt_parser.parse_args()
+
+    if options.filename:
+        run(options.filename, options.repeat)
+    else:
+        fd, filename = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+        try:
+            write_aggregate(filename, options.entities)
+            run(filename, options.repeat)
+        finally:
+            os.unlink(filename)
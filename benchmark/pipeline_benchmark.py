@@ -0,0 +1,115 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Compare the native load/select pipeline with the pyff one on a large
+# aggregate: import time, wall time and peak memory. Every pipeline runs
+# in its own process so that their imports and peak memory are apart.
+#
+#   python benchmark/pipeline_benchmark.py [--file <aggregate>] [--entities <num>]
+
+import sys, os
+import time
+import resource
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+current_directory = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(current_directory)
+
+from synthetic import write_aggregate
+
+PIPELINES = ('native', 'pyff')
+
+
+def _native(load_streams, output):
+    from met.metadataparser.pipeline import select_entities
+    yield
+    select_entities(load_streams, output)
+
+
+def _pyff(load_streams, output):
+    # The same pipeline as Federation._pyff_select
+    from lxml import etree
+    from pyff.mdrepo import MDRepository
+    from pyff.pipes import Plumbing
+    yield
+    load = ['%s as source%d' % (filename, num) for num, (filename, _) in enumerate(load_streams)]
+    select = ['source%d!//md:EntityDescriptor[md:%sSSODescriptor]' % (num, selector)
+              for num, (_, selector) in enumerate(load_streams)]
+    md = MDRepository()
+    entities = Plumbing(pipeline=[{'load': load}, {'select': select}], id='benchmark').process(
+        md, state={'batch': True, 'stats': {}})
+    etree.ElementTree(entities).write(output)
+
+
+def run_pipeline(name, filename, output_name):
+    '''Run a pipeline in this process and print its measures'''
+    load_streams = [[filename, 'IDP'], [filename, 'SP']]
+    with open(output_name, 'wb') as output:
+        start = time.time()
+        steps = globals()['_' + name](load_streams, output)
+        next(steps)
+        print('%f' % (time.time() - start))
+        sys.stdout.flush()
+        start = time.time()
+        for _ in steps:
+            pass
+        run_time = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%f %d %d' % (run_time, peak_rss, os.path.getsize(output_name)))
+
+
+def run(filename, directory):
+    print('%-7s %10s %10s %14s %12s' % ('', 'import s', 'run s', 'peak RSS KiB', 'output'))
+    for name in PIPELINES:
+        output_name = os.path.join(directory, '%s.xml' % name)
+        child = subprocess.Popen([sys.executable, __file__, '--run', name, '--file', filename,
+                                  '--output', output_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = child.communicate()
+        measures = out.split()
+        if child.returncode != 0:
+            error = err.strip().splitlines()[-1] if err.strip() else child.returncode
+            import_time = '%10.2f' % float(measures[0]) if measures else '%10s' % '-'
+            print('%-7s %s  failed: %s' % (name, import_time, error))
+            continue
+        import_time, run_time, peak_rss, size = measures
+        print('%-7s %10.2f %10.2f %14s %12s' % (name, float(import_time), float(run_time), peak_rss, size))
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.set_usage("pipeline_benchmark [--file <aggregate>] [--entities <num>]")
+    opt_parser.add_option("-f", "--file", type="string", dest="filename", default=None,
+                          help="The aggregate to use (a synthetic one is generated if missing)")
+    opt_parser.add_option("-e", "--entities", type="int", dest="entities", default=20000,
+                          help="Number of entities of the synthetic aggregate")
+    opt_parser.add_option("--run", type="choice", dest="pipeline", choices=PIPELINES, default=None,
+                          help="Run a single pipeline (used by the benchmark itself)")
+    opt_parser.add_option("--output", type="string", dest="output", default=None,
+                          help="Output file of the pipeline run with --run")
+    (options, _) = opt_parser.parse_args()
+
+    if options.pipeline:
+        run_pipeline(options.pipeline, options.filename, options.output)
+        sys.exit(0)
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = options.filename
+        if not filename:
+            filename = os.path.join(directory, 'metadata.xml')
+            write_aggregate(filename, options.entities)
+        run(filename, directory)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,96 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Synthetic eduGAIN-like aggregate shared by the benchmark scripts
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi" xmlns:shibmd="urn:mace:shibboleth:metadata:1.0" xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui" xmlns:ds="http://www.w3.org/2000/09/xmldsig#" xmlns:mdattr="urn:oasis:names:tc:SAML:metadata:attribute" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" Name="urn:benchmark" ID="BENCHMARK">
+'''
+
+FOOTER = '''</md:EntitiesDescriptor>
+'''
+
+IDP = '''  <md:EntityDescriptor entityID="https://idp%(num)d.example.org/idp/shibboleth">
+    <md:Extensions>
+      <mdrpi:RegistrationInfo registrationAuthority="http://www.example.org/" registrationInstant="2015-02-16T14:25:08Z">
+        <mdrpi:RegistrationPolicy xml:lang="en">http://www.example.org/policy</mdrpi:RegistrationPolicy>
+      </mdrpi:RegistrationInfo>
+      <mdattr:EntityAttributes>
+        <saml:Attribute Name="http://macedir.org/entity-category-support">
+          <saml:AttributeValue>http://refeds.org/category/research-and-scholarship</saml:AttributeValue>
+        </saml:Attribute>
+      </mdattr:EntityAttributes>
+    </md:Extensions>
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol urn:mace:shibboleth:1.0">
+      <md:Extensions>
+        <shibmd:Scope regexp="false">idp%(num)d.example.org</shibmd:Scope>
+        <mdui:UIInfo>
+          <mdui:DisplayName xml:lang="en">Identity Provider %(num)d</mdui:DisplayName>
+          <mdui:DisplayName xml:lang="it">Identity Provider %(num)d (it)</mdui:DisplayName>
+          <mdui:Description xml:lang="en">Identity Provider number %(num)d</mdui:Description>
+          <mdui:InformationURL xml:lang="en">https://idp%(num)d.example.org/info</mdui:InformationURL>
+          <mdui:PrivacyStatementURL xml:lang="en">https://idp%(num)d.example.org/privacy</mdui:PrivacyStatementURL>
+          <mdui:Logo height="16" width="16" xml:lang="en">https://idp%(num)d.example.org/logo.png</mdui:Logo>
+        </mdui:UIInfo>
+      </md:Extensions>
+      <md:KeyDescriptor>
+        <ds:KeyInfo><ds:X509Data><ds:X509Certificate>%(certificate)s</ds:X509Certificate></ds:X509Data></ds:KeyInfo>
+      </md:KeyDescriptor>
+      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect" Location="https://idp%(num)d.example.org/sso"/>
+    </md:IDPSSODescriptor>
+    <md:Organization>
+      <md:OrganizationName xml:lang="en">Organization %(num)d</md:OrganizationName>
+      <md:OrganizationDisplayName xml:lang="en">Organization %(num)d</md:OrganizationDisplayName>
+      <md:OrganizationURL xml:lang="en">https://www%(num)d.example.org/</md:OrganizationURL>
+    </md:Organization>
+    <md:ContactPerson contactType="technical">
+      <md:GivenName>John</md:GivenName>
+      <md:SurName>Doe</md:SurName>
+      <md:EmailAddress>mailto:technical@idp%(num)d.example.org</md:EmailAddress>
+    </md:ContactPerson>
+  </md:EntityDescriptor>
+'''
+
+SP = '''  <md:EntityDescriptor entityID="https://sp%(num)d.example.org/shibboleth">
+    <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:Extensions>
+        <mdui:UIInfo>
+          <mdui:DisplayName xml:lang="en">Service Provider %(num)d</mdui:DisplayName>
+        </mdui:UIInfo>
+      </md:Extensions>
+      <md:KeyDescriptor>
+        <ds:KeyInfo><ds:X509Data><ds:X509Certificate>%(certificate)s</ds:X509Certificate></ds:X509Data></ds:KeyInfo>
+      </md:KeyDescriptor>
+      <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" Location="https://sp%(num)d.example.org/acs" index="1"/>
+      <md:AttributeConsumingService index="1">
+        <md:ServiceName xml:lang="en">Service %(num)d</md:ServiceName>
+        <md:RequestedAttribute FriendlyName="mail" Name="urn:oid:0.9.2342.19200300.100.1.3" isRequired="true"/>
+        <md:RequestedAttribute FriendlyName="givenName" Name="urn:oid:2.5.4.42"/>
+      </md:AttributeConsumingService>
+    </md:SPSSODescriptor>
+    <md:ContactPerson contactType="support">
+      <md:EmailAddress>mailto:support@sp%(num)d.example.org</md:EmailAddress>
+    </md:ContactPerson>
+  </md:EntityDescriptor>
+'''
+
+CERTIFICATE = 'MIIDdzCCAl+gAwIBAgIJAK' + 'A' * 1100
+
+
+def write_aggregate(filename, entities):
+    '''Write an aggregate with the given number of alternating IdPs and SPs'''
+    with open(filename, 'wb') as aggregate:
+        aggregate.write(HEADER)
+        for num in xrange(entities):
+            template = IDP if num % 2 == 0 else SP
+            aggregate.write(template % {'num': num, 'certificate': CERTIFICATE})
+        aggregate.write(FOOTER)
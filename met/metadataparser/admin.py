@@ -12,7 +12,7 @@
 
 from django.contrib import admin
 
-from met.metadataparser.models import Federation, Entity
+from met.metadataparser.models import Federation, Entity, IngestJob, RefreshReport
 
 
 class FederationAdmin(admin.ModelAdmin):
@@ -23,5 +23,20 @@ class EntityAdmin(admin.ModelAdmin):
     pass
 
 
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ('federation', 'kind', 'status', 'created', 'started', 'finished')
+    list_filter = ('status', 'kind')
+
+
+class RefreshReportAdmin(admin.ModelAdmin):
+    list_display = ('federation', 'started', 'total_time', 'fetch_time', 'compare_time', 'parse_time',
+                    'entities_time', 'stats_time', 'bytes_fetched', 'entities_added', 'entities_updated',
+                    'entities_removed', 'queries', 'peak_rss_growth', 'error')
+    list_filter = ('federation',)
+    date_hierarchy = 'started'
+
+
 admin.site.register(Federation, FederationAdmin)
 admin.site.register(Entity, EntityAdmin)
+admin.site.register(IngestJob, IngestJobAdmin)
+admin.site.register(RefreshReport, RefreshReportAdmin)
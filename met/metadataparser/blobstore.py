@@ -0,0 +1,97 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Fetched metadata is stored once per content, under its SHA-256, so that
+# federations pulling the same aggregates share the stored file and its
+# entity index. Blobs no longer referenced are removed by collect_garbage.
+
+import re
+import time
+from os import path
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import default_storage
+
+from met.metadataparser.compression import COMPRESSION_SUFFIXES, blocks_path, remove_blocks
+from met.metadataparser.entity_index import remove_index
+
+BLOB_DIRECTORY = getattr(settings, 'METADATA_BLOB_DIRECTORY', 'metadata/blobs')
+BLOB_FILE = re.compile(r'^[0-9a-f]{64}\.xml(%s)?$' % '|'.join(re.escape(suffix)
+                                                              for suffix in COMPRESSION_SUFFIXES.values()))
+
+
+def blob_name(sha256, compression=None):
+    '''Return the storage name of the blob with the given SHA-256'''
+    name = '%s/%s/%s.xml' % (BLOB_DIRECTORY, sha256[:2], sha256)
+    if compression:
+        name += COMPRESSION_SUFFIXES[compression]
+    return name
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_DIRECTORY + '/')
+
+
+def _store(name, filename):
+    if default_storage.exists(name):
+        return
+    with open(filename, 'rb') as stored_file:
+        stored = default_storage.save(name, File(stored_file))
+    if stored != name:
+        # Stored meanwhile by another process, with the same content
+        default_storage.delete(stored)
+
+
+def store_blob(name, filename):
+    '''Store the file named filename as the blob name, unless it is already
+    stored, with the block table of a compressed file'''
+    if default_storage.exists(name):
+        return
+    # The table goes first, a stored blob always has its own
+    if path.exists(blocks_path(filename)):
+        _store(blocks_path(name), blocks_path(filename))
+    _store(name, filename)
+
+
+def _iter_blobs():
+    if not default_storage.exists(BLOB_DIRECTORY):
+        return
+    directories, _ = default_storage.listdir(BLOB_DIRECTORY)
+    for directory in directories:
+        _, files = default_storage.listdir('%s/%s' % (BLOB_DIRECTORY, directory))
+        for blob in files:
+            if BLOB_FILE.match(blob):
+                yield '%s/%s/%s' % (BLOB_DIRECTORY, directory, blob)
+
+
+def collect_garbage(referenced, min_age=3600, dry_run=False):
+    '''Delete, with their entity indexes, the blobs not in referenced that
+    were stored more than min_age seconds ago, and return their names
+
+    min_age protects the blobs just stored by a refresh that has not saved
+    its federation yet.
+    '''
+    referenced = set(referenced)
+    now = time.time()
+    collected = []
+    for name in _iter_blobs():
+        if name in referenced:
+            continue
+        if now - time.mktime(default_storage.modified_time(name).timetuple()) < min_age:
+            continue
+        if not dry_run:
+            remove_index(default_storage.path(name))
+            remove_blocks(default_storage.path(name))
+            default_storage.delete(name)
+        collected.append(name)
+    return collected
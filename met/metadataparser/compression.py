@@ -0,0 +1,223 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+import os
+import gzip
+import zlib
+import struct
+from bisect import bisect_right
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz storage needs backports.lzma on python 2
+        lzma = None
+
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'xz': '.xz',
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# gzip files are written as independent members of BLOCK_SIZE uncompressed
+# bytes, with a table of where every member starts next to the file, so
+# that reading an entity only decompresses the member it is in.
+BLOCK_SIZE = 1024 * 1024
+BLOCKS_SUFFIX = '.blocks'
+BLOCK = struct.Struct('<QQ')    # uncompressed offset, compressed offset
+
+
+def get_compression(filename):
+    '''Return the compression of a stored metadata file from its name'''
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return compression
+    return None
+
+
+def _check_compression(compression):
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError('Unknown compression: %s' % compression)
+    if compression == 'xz' and lzma is None:
+        raise ValueError('xz compression requires the backports.lzma package')
+
+
+def blocks_path(filename):
+    return filename + BLOCKS_SUFFIX
+
+
+def remove_blocks(filename):
+    try:
+        os.unlink(blocks_path(filename))
+    except OSError:
+        pass
+
+
+def _load_blocks(filename):
+    '''Return the member table of a blocked gzip file, None if it has none'''
+    try:
+        with open(blocks_path(filename), 'rb') as table:
+            data = table.read()
+    except IOError:
+        return None
+
+    if len(data) < 2 * BLOCK.size or len(data) % BLOCK.size:
+        return None
+    # The first record holds the uncompressed and the compressed sizes
+    _, size = BLOCK.unpack_from(data, 0)
+    if size != os.path.getsize(filename):
+        return None
+    return [BLOCK.unpack_from(data, pos) for pos in xrange(BLOCK.size, len(data), BLOCK.size)]
+
+
+class BlockedGzipFile(object):
+    '''Read only view of a gzip file written by compress_file
+
+    A seek only decompresses from the start of the member holding the new
+    position, instead of from the start of the file.
+    '''
+
+    def __init__(self, filename, blocks):
+        self._file = open(filename, 'rb')
+        self._blocks = blocks
+        self._starts = [start for start, _ in blocks]
+        self._block = None
+        self._seek_block(0)
+
+    def _seek_block(self, block):
+        start, offset = self._blocks[block]
+        self._file.seek(offset)
+        self._block = block
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ''
+        self._position = start
+
+    def _fill(self):
+        '''Decompress more of the file into the buffer, False at its end'''
+        while True:
+            data = self._decompressor.unused_data
+            if data:
+                # The member ended, the rest of what was read is the next one
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self._file.read(CHUNK_SIZE)
+                if not data:
+                    return False
+            self._buffer = self._decompressor.decompress(data)
+            if self._buffer:
+                return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if not self._buffer and not self._fill():
+                break
+            part = self._buffer if size < 0 else self._buffer[:size]
+            self._buffer = self._buffer[len(part):]
+            self._position += len(part)
+            parts.append(part)
+            if size > 0:
+                size -= len(part)
+        return ''.join(parts)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence != 0:
+            raise IOError('Seeking from the end is not supported')
+
+        block = bisect_right(self._starts, offset) - 1
+        if offset < self._position or block > self._block:
+            self._seek_block(max(block, 0))
+        while self._position < offset:
+            if not self.read(min(offset - self._position, CHUNK_SIZE)):
+                break
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_metadata(filename):
+    '''Open a stored metadata file for reading, decompressing it on the fly
+
+    Compressed streams support seek(). In gzip files written by
+    compress_file a seek decompresses at most BLOCK_SIZE bytes. In any
+    other compressed file every seek backwards starts decompressing from
+    the beginning of the file again.
+    '''
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, 'rb')
+
+    _check_compression(compression)
+    if compression == 'gzip':
+        blocks = _load_blocks(filename)
+        if blocks is not None:
+            return BlockedGzipFile(filename, blocks)
+        return gzip.GzipFile(filename, 'rb')
+    return lzma.LZMAFile(filename, 'rb')
+
+
+def _compress_member(block, compressed):
+    # Every block is a complete gzip member, readable on its own
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed.write(compressor.compress(block))
+    compressed.write(compressor.flush())
+
+
+def _compress_blocks(source, destination):
+    blocks = []
+    position = 0
+    with open(destination, 'wb') as compressed:
+        for block in iter(lambda: source.read(BLOCK_SIZE), ''):
+            blocks.append((position, compressed.tell()))
+            _compress_member(block, compressed)
+            position += len(block)
+        if not blocks:
+            # An empty document still needs a member to be a gzip file
+            blocks.append((0, 0))
+            _compress_member('', compressed)
+        size = compressed.tell()
+
+    with open(blocks_path(destination), 'wb') as table:
+        table.write(BLOCK.pack(position, size))
+        table.write(''.join(BLOCK.pack(*block) for block in blocks))
+
+
+def compress_file(source, destination, compression):
+    '''Compress the open file source into the file named destination,
+    a chunk at a time
+
+    gzip files are written in blocks, with their member table in
+    blocks_path(destination).
+    '''
+    _check_compression(compression)
+    if compression == 'gzip':
+        _compress_blocks(source, destination)
+        return
+
+    with lzma.LZMAFile(destination, 'wb') as compressed:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), ''):
+            compressed.write(chunk)
@@ -0,0 +1,374 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+import os
+import re
+import mmap
+import struct
+import hashlib
+import tempfile
+from binascii import hexlify
+from collections import OrderedDict
+
+import simplejson as json
+
+from met.metadataparser.compression import open_metadata
+
+INDEX_CHUNK_SIZE = 1024 * 1024
+
+# Markup the entity index scanner has to recognize: comments and CDATA
+# sections (so that commented out entities are skipped), the start tags of
+# EntitiesDescriptor/EntityDescriptor and the end tag of EntityDescriptor.
+_INDEX_START_RE = re.compile(r'<(?:!--|!\[CDATA\[|/?(?:[A-Za-z_][\w.-]*:)?Entit(?:y|ies)Descriptor)')
+_INDEX_TOKEN_RE = re.compile(
+    r'<!--.*?-->'
+    r'|<!\[CDATA\[.*?\]\]>'
+    r'|<(?:[A-Za-z_][\w.-]*:)?(?P<tag>EntitiesDescriptor|EntityDescriptor)(?=[\s/>])'
+    r'(?P<attrs>(?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(?P<empty>/?)>'
+    r'|</(?:[A-Za-z_][\w.-]*:)?(?P<endtag>EntityDescriptor)\s*>',
+    re.DOTALL)
+_INDEX_TERMINATORS = {'<!--': '-->', '<![CDATA[': ']]>'}
+_ENTITYID_ATTR_RE = re.compile(r'\sentityID\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_XMLNS_ATTR_RE = re.compile(r'\sxmlns(?::([A-Za-z_][\w.-]*))?\s*=\s*(?:"[^"]*"|\'[^\']*\')')
+_XML_ENCODING_RE = re.compile(r'^(?:\xef\xbb\xbf)?<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z][\w.-]*)["\']')
+_CHAR_REF_RE = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+_PREDEFINED_ENTITIES = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"', 'apos': u"'"}
+
+
+def _unescape_attribute(value, encoding):
+    '''Return the value of a raw XML attribute as the XML parser would'''
+    def _replace(match):
+        ref = match.group(1)
+        if ref.startswith('#x'):
+            return unichr(int(ref[2:], 16))
+        elif ref.startswith('#'):
+            return unichr(int(ref[1:]))
+        return _PREDEFINED_ENTITIES[ref]
+
+    value = re.sub(r'[\t\r\n]', ' ', value.decode(encoding))
+    return _CHAR_REF_RE.sub(_replace, value)
+
+
+def scan_entities(stream, chunk_size=INDEX_CHUNK_SIZE):
+    '''Scan a metadata stream without parsing it
+
+    Return a tuple (encoding, namespaces, entities) where namespaces maps
+    every prefix declared on an EntitiesDescriptor to its raw xmlns
+    declaration and entities is the list of (entityid, offset, length) of
+    every EntityDescriptor in document order, with offset and length
+    measured in bytes.
+    '''
+    namespaces = OrderedDict()
+    entities = []
+    current = None
+
+    # The XML declaration must be read at once to detect the encoding
+    buf = stream.read(max(chunk_size, 1024))
+    enc_match = _XML_ENCODING_RE.match(buf)
+    encoding = enc_match.group(1) if enc_match else 'utf-8'
+
+    base = 0
+    pos = 0
+    eof = not buf
+    while True:
+        start = _INDEX_START_RE.search(buf, pos)
+        match = start and _INDEX_TOKEN_RE.match(buf, start.start())
+        if not match:
+            if start is None:
+                # Anything incomplete must start at the last '<' in the buffer
+                keep = buf.rfind('<', pos)
+                if keep < 0:
+                    keep = len(buf)
+            elif buf.find(_INDEX_TERMINATORS.get(start.group(0), '>'), start.end()) < 0:
+                keep = start.start()
+            else:
+                # Not a token we are interested in
+                pos = start.end()
+                continue
+
+            if eof:
+                break
+
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            base += keep
+            buf = buf[keep:] + chunk
+            pos = 0
+            continue
+
+        pos = match.end()
+        if match.group('tag') == 'EntitiesDescriptor':
+            for decl in _XMLNS_ATTR_RE.finditer(match.group('attrs')):
+                namespaces[decl.group(1)] = decl.group(0)
+        elif match.group('tag') == 'EntityDescriptor' and current is None:
+            id_match = _ENTITYID_ATTR_RE.search(match.group('attrs'))
+            if id_match is None:
+                continue
+
+            raw_entityid = id_match.group(1)
+            if raw_entityid is None:
+                raw_entityid = id_match.group(2)
+            current = (_unescape_attribute(raw_entityid, encoding), base + match.start())
+            if match.group('empty'):
+                entities.append((current[0], current[1], base + pos - current[1]))
+                current = None
+        elif match.group('endtag') and current is not None:
+            entities.append((current[0], current[1], base + pos - current[1]))
+            current = None
+
+    return encoding, namespaces, entities
+
+
+def standalone_fragment(fragment, namespaces):
+    '''Declare on the start tag of an EntityDescriptor fragment the
+    namespaces it inherits from the enclosing EntitiesDescriptor'''
+    match = _INDEX_TOKEN_RE.match(fragment)
+    if match is None or match.group('tag') is None:
+        return fragment
+
+    declared = set(decl.group(1) for decl in _XMLNS_ATTR_RE.finditer(match.group('attrs')))
+    missing = ''.join(decl for prefix, decl in namespaces.items() if prefix not in declared)
+    return fragment[:match.start('attrs')] + missing + fragment[match.start('attrs'):]
+
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = 'METIDX02'
+
+# Sidecar layout: header, JSON with encoding and namespaces, one record per
+# entity in document order, the record numbers sorted by entityid and
+# finally the UTF-8 encoded entityids.
+HEADER = struct.Struct('<8s32sQdII')    # magic, content sha256, size, mtime, count, JSON length
+RECORD = struct.Struct('<QIII20s')      # offset, length, key offset, key length, sha1
+POSITION = struct.Struct('<I')
+
+
+def index_path(filename):
+    return filename + INDEX_SUFFIX
+
+
+def remove_index(filename):
+    try:
+        os.unlink(index_path(filename))
+    except OSError:
+        pass
+
+
+def _file_fingerprint(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+class EntityIndex(object):
+    '''Map every entityid of a metadata file to the byte range and the sha1
+    digest of its EntityDescriptor. content_digest is the SHA-256 of the
+    whole (uncompressed) document.'''
+
+    def __init__(self, encoding, namespaces, entries, content_digest=None):
+        self.encoding = encoding
+        self.namespaces = namespaces
+        self.content_digest = content_digest
+        self._entries = entries
+        self._lookup = {}
+        for entityid, offset, length, digest in entries:
+            self._lookup.setdefault(entityid, (offset, length, digest))
+
+    @classmethod
+    def build(cls, filename):
+        with open_metadata(filename) as stream:
+            return cls.from_stream(stream)
+
+    @classmethod
+    def from_stream(cls, stream):
+        '''Index a seekable stream over a metadata document'''
+        encoding, namespaces, entities = scan_entities(stream)
+
+        content_hash = hashlib.sha256()
+        entries = []
+        position = 0
+        stream.seek(0)
+        for entityid, offset, length in entities:
+            # Hash the whole content while reading every fragment once
+            content_hash.update(stream.read(offset - position))
+            fragment = stream.read(length)
+            content_hash.update(fragment)
+            position = offset + length
+            entries.append((entityid, offset, length, hashlib.sha1(fragment).digest()))
+
+        for chunk in iter(lambda: stream.read(INDEX_CHUNK_SIZE), ''):
+            content_hash.update(chunk)
+
+        return cls(encoding, namespaces, entries, content_hash.digest())
+
+    def __contains__(self, entityid):
+        return entityid in self._lookup
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return (entry[0] for entry in self._entries)
+
+    def ranges(self):
+        '''Yield (entityid, offset, length) of every entity in document order'''
+        return (entry[:3] for entry in self._entries)
+
+    def get(self, entityid):
+        return self._lookup.get(entityid, None)
+
+    def write(self, filename):
+        '''Store the index next to filename, replacing any older sidecar'''
+        size, mtime = _file_fingerprint(filename)
+        meta = json.dumps({'encoding': self.encoding, 'namespaces': self.namespaces.items()})
+
+        keys = []
+        records = []
+        key_offset = 0
+        for entityid, offset, length, digest in self._entries:
+            key = entityid.encode('utf-8')
+            records.append(RECORD.pack(offset, length, key_offset, len(key), digest))
+            keys.append(key)
+            key_offset += len(key)
+        positions = sorted(range(len(keys)), key=lambda pos: (keys[pos], pos))
+
+        dirname = os.path.dirname(filename) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=INDEX_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as sidecar:
+                sidecar.write(HEADER.pack(INDEX_MAGIC, self.content_digest or '\0' * 32,
+                                          size, mtime, len(records), len(meta)))
+                sidecar.write(meta)
+                sidecar.write(''.join(records))
+                sidecar.write(''.join(POSITION.pack(pos) for pos in positions))
+                sidecar.write(''.join(keys))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, index_path(filename))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+class MappedEntityIndex(object):
+    '''Read only view of a sidecar index through mmap
+
+    Lookups are a binary search over the sorted record numbers, so opening
+    the index and finding an entity never reads the whole sidecar.
+    '''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.content_digest, self.size, self.mtime, self._count, meta_length = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('Not a metadata index')
+
+        meta = json.loads(self._map[HEADER.size:HEADER.size + meta_length])
+        self.encoding = meta['encoding']
+        self.namespaces = OrderedDict(meta['namespaces'])
+
+        self._records_start = HEADER.size + meta_length
+        self._positions_start = self._records_start + self._count * RECORD.size
+        self._keys_start = self._positions_start + self._count * POSITION.size
+
+    @classmethod
+    def open(cls, filename, content_digest=None):
+        '''Return the sidecar index of filename or None if it is missing or stale
+
+        Without the hex SHA-256 of the document in content_digest, the index
+        is only checked against the size and the mtime of the file, which
+        miss a rewrite of the same size within the mtime granularity.
+        '''
+        try:
+            stream = open(index_path(filename), 'rb')
+        except IOError:
+            return None
+
+        try:
+            index = cls(stream)
+        except (ValueError, struct.error, mmap.error, EnvironmentError):
+            stream.close()
+            return None
+
+        if ((index.size, index.mtime) != _file_fingerprint(filename) or
+                (content_digest and hexlify(index.content_digest) != content_digest)):
+            index.close()
+            return None
+        return index
+
+    def close(self):
+        self._map.close()
+        self._stream.close()
+
+    def _record(self, pos):
+        return RECORD.unpack_from(self._map, self._records_start + pos * RECORD.size)
+
+    def _key(self, record):
+        start = self._keys_start + record[2]
+        return self._map[start:start + record[3]]
+
+    def _find(self, entityid):
+        key = entityid.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            pos = POSITION.unpack_from(self._map, self._positions_start + middle * POSITION.size)[0]
+            if self._key(self._record(pos)) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._count:
+            pos = POSITION.unpack_from(self._map, self._positions_start + low * POSITION.size)[0]
+            record = self._record(pos)
+            if self._key(record) == key:
+                return record
+        return None
+
+    def __contains__(self, entityid):
+        return self._find(entityid) is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for pos in xrange(self._count):
+            yield self._key(self._record(pos)).decode('utf-8')
+
+    def ranges(self):
+        '''Yield (entityid, offset, length) of every entity in document order'''
+        for pos in xrange(self._count):
+            record = self._record(pos)
+            yield self._key(record).decode('utf-8'), record[0], record[1]
+
+    def get(self, entityid):
+        record = self._find(entityid)
+        if record is None:
+            return None
+        return record[0], record[1], record[4]
+
+
+def load_index(filename, content_digest=None):
+    '''Return the index of filename, building and storing it if needed'''
+    index = MappedEntityIndex.open(filename, content_digest)
+    if index is not None:
+        return index
+
+    index = EntityIndex.build(filename)
+    try:
+        index.write(filename)
+    except EnvironmentError:
+        # The directory may be read only for this process
+        return index
+
+    return MappedEntityIndex.open(filename) or index
@@ -0,0 +1,120 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+import time
+import hashlib
+import requests
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from django.conf import settings
+
+FETCH_TIMEOUT = getattr(settings, 'METADATA_FETCH_TIMEOUT', 60)
+FETCH_RETRIES = getattr(settings, 'METADATA_FETCH_RETRIES', 2)
+FETCH_WORKERS = getattr(settings, 'METADATA_FETCH_WORKERS', 4)
+RETRY_DELAY = 1
+CHUNK_SIZE = 64 * 1024
+
+
+class DigestFile(object):
+    '''File wrapper computing the SHA-256 and the size of what is written'''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def file_digest(fileobj):
+    '''Return the SHA-256 of what is left to read in fileobj'''
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), ''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_remote(url):
+    return urlparse(url).scheme in ('http', 'https')
+
+
+def _retry(error):
+    '''Tell if a failed download is worth trying again'''
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def fetch_source(url, filename, etag=None, last_modified=None, timeout=FETCH_TIMEOUT,
+                 retries=FETCH_RETRIES):
+    '''Download a metadata source to filename, sending the validators of its
+    last fetch. The body is streamed to disk and never held in memory.
+    Connection errors, timeouts and server errors are retried up to retries
+    times.
+
+    Return (size, etag, last_modified) where size is None if the server
+    answered 304 Not Modified.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return _fetch_once(url, filename, etag, last_modified, timeout)
+        except requests.RequestException, e:
+            if attempt == retries or not _retry(e):
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def fetch_sources(sources, workers=FETCH_WORKERS):
+    '''Download several sources concurrently
+
+    sources is a list of (url, filename, etag, last_modified), the result
+    is the list of what fetch_source returned for each of them.
+    '''
+    if len(sources) <= 1 or workers <= 1:
+        return [fetch_source(*source) for source in sources]
+
+    pool = ThreadPool(min(workers, len(sources)))
+    try:
+        return pool.map(lambda source: fetch_source(*source), sources)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fetch_once(url, filename, etag, last_modified, timeout):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    response = requests.get(url, headers=headers, timeout=timeout, stream=True)
+    try:
+        if response.status_code == 304:
+            return None, etag, last_modified
+        response.raise_for_status()
+
+        size = 0
+        with open(filename, 'wb') as source_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                source_file.write(chunk)
+                size += len(chunk)
+        return size, response.headers.get('ETag'), response.headers.get('Last-Modified')
+    finally:
+        response.close()
@@ -0,0 +1,44 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Deletes the stored metadata blobs no federation or entity references:
+#
+#   python manage.py met_gc_blobs [--min-age <seconds>] [--dry-run]
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from met.metadataparser.blobstore import collect_garbage
+from met.metadataparser.models import Entity, Federation
+
+
+class Command(BaseCommand):
+    help = 'Delete the metadata blobs that are no longer referenced'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--min-age', type='int', dest='min_age', default=3600,
+                    help='Keep the blobs stored less than this number of seconds ago'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only list the blobs that would be deleted'),
+    )
+
+    def handle(self, *args, **options):
+        referenced = set()
+        for model in (Federation, Entity):
+            referenced.update(model.objects.exclude(file='').exclude(file__isnull=True)
+                              .values_list('file', flat=True))
+
+        collected = collect_garbage(referenced, options['min_age'], options['dry_run'])
+        for name in collected:
+            self.stdout.write(name)
+        self.stdout.write('%d blobs %s' % (len(collected), 'unreferenced' if options['dry_run'] else 'deleted'))
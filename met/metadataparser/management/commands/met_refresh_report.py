@@ -0,0 +1,58 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Shows the stage timings of the last metadata refreshes of each federation:
+#
+#   python manage.py met_refresh_report [--federation <slug>] [--last <num>]
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from met.metadataparser.models import Federation, RefreshReport
+
+COLUMNS = ('%-19s %8s %8s %8s %8s %9s %8s %12s %7s %7s %7s %7s %9s %s')
+
+
+class Command(BaseCommand):
+    help = 'Show the timing reports of the last metadata refreshes'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--federation', type='string', dest='federation', default=None,
+                    help='Slug of the federation to report (all of them by default)'),
+        make_option('--last', type='int', dest='last', default=10,
+                    help='Number of refreshes to show for each federation'),
+    )
+
+    def handle(self, *args, **options):
+        federations = Federation.objects.order_by('slug')
+        if options['federation']:
+            federations = federations.filter(slug=options['federation'])
+
+        for federation in federations:
+            reports = list(RefreshReport.objects.filter(federation=federation)[:options['last']])
+            if not reports:
+                continue
+
+            self.stdout.write('[%s]' % federation)
+            self.stdout.write(COLUMNS % ('started', 'total', 'fetch', 'compare', 'parse', 'entities', 'stats',
+                                         'bytes', 'added', 'updated', 'removed', 'queries', '+rss KB', ''))
+            # Oldest first, so that trends read from top to bottom
+            for report in reversed(reports):
+                self.stdout.write(COLUMNS % (report.started.strftime('%Y-%m-%d %H:%M:%S'), '%.2f' % report.total_time,
+                                             '%.2f' % report.fetch_time, '%.2f' % report.compare_time,
+                                             '%.2f' % report.parse_time, '%.2f' % report.entities_time,
+                                             '%.2f' % report.stats_time, report.bytes_fetched,
+                                             report.entities_added, report.entities_updated,
+                                             report.entities_removed, report.queries, report.peak_rss_growth,
+                                             'error: %s' % report.error if report.error else ''))
+            self.stdout.write('')
@@ -0,0 +1,53 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+# Runs the federation jobs queued by the web views:
+#
+#   python manage.py met_worker [--once] [--sleep <seconds>]
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from met.metadataparser.models import IngestJob
+
+
+class Command(BaseCommand):
+    help = 'Run the queued federation update jobs'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit when there are no more queued jobs'),
+        make_option('--sleep', type='int', dest='sleep', default=5,
+                    help='Seconds to wait before looking for new jobs'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            if not connection.in_atomic_block:
+                # Inside a transaction, such as a test, the connection is kept
+                close_old_connections()
+            job = IngestJob.claim()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            self.stdout.write('[%s] Running job %s (%s) ...' % (job.federation, job.id, job.kind))
+            job.run()
+            if job.status == 'failed':
+                self.stderr.write('[%s] Job %s failed: %s' % (job.federation, job.id, job.error))
+            else:
+                self.stdout.write('[%s] Job %s done in %.2fs: %s' % (job.federation, job.id, job.duration, job.result))
@@ -12,22 +12,31 @@
 
 import simplejson as json
 import pytz
+import shutil
+import logging
+import hashlib
+import tempfile
+import threading
 
 from os import path
+from contextlib import contextmanager
 from urlparse import urlparse
 from urllib import quote_plus
 from datetime import datetime, time, timedelta
+from time import time as current_time
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.core import validators
 from django.core.cache import cache
-from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
 from django.db.models import Count, Max
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save
 from django.db.models.query import QuerySet
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify
@@ -37,17 +46,33 @@ from django.utils import timezone
 
 from lxml import etree
 
-from pyff.mdrepo import MDRepository
-from pyff.pipes import Plumbing
 
-from met.metadataparser.utils import compare_filecontents
-from met.metadataparser.xmlparser import MetadataParser, DESCRIPTOR_TYPES_DISPLAY
+from met.metadataparser.compression import COMPRESSION_SUFFIXES, compress_file, open_metadata
+from met.metadataparser.entity_index import remove_index
+from met.metadataparser.blobstore import blob_name, is_blob, store_blob
+from met.metadataparser.fetch import DigestFile, fetch_sources, file_digest, is_remote
+from met.metadataparser.pipeline import can_select, select_entities
+from met.metadataparser.utils import federation_lock
+from met.metadataparser.xmlparser import MetadataParser, DESCRIPTOR_TYPES_DISPLAY, PARALLEL_MIN_SIZE
 from met.metadataparser.templatetags import attributemap
 
 
 TOP_LENGTH = getattr(settings, "TOP_LENGTH", 5)
+PARSER_WORKERS = getattr(settings, "METADATA_PARSER_WORKERS", 1)
+PARSER_PARALLEL_MIN_SIZE = getattr(settings, "METADATA_PARSER_PARALLEL_MIN_SIZE", PARALLEL_MIN_SIZE)
+METADATA_COMPRESSION = getattr(settings, "METADATA_COMPRESSION", None)
+METADATA_NATIVE_PIPELINE = getattr(settings, "METADATA_NATIVE_PIPELINE", True)
+INGEST_BATCH_SIZE = getattr(settings, "INGEST_BATCH_SIZE", 500)
+INGEST_CHECKPOINT_SIZE = getattr(settings, "INGEST_CHECKPOINT_SIZE", 5000)
+INGEST_PROGRESS_ENTITIES = getattr(settings, "INGEST_PROGRESS_ENTITIES", 100)
+INGEST_PROGRESS_INTERVAL = getattr(settings, "INGEST_PROGRESS_INTERVAL", 1000)
+INGEST_PROGRESS_TIMEOUT = getattr(settings, "INGEST_PROGRESS_TIMEOUT", 24 * 60 * 60)
+INGEST_JOB_HEARTBEAT = getattr(settings, "INGEST_JOB_HEARTBEAT", 60)
+INGEST_JOB_TIMEOUT = getattr(settings, "INGEST_JOB_TIMEOUT", 10 * 60)
 stats = getattr(settings, "STATS")
 
+logger = logging.getLogger(__name__)
+
 FEDERATION_TYPES = (
     (None, ''),
     ('hub-and-spoke', 'Hub and Spoke'),
@@ -55,6 +80,30 @@ FEDERATION_TYPES = (
 )
 
 
+def _chunks(items, size=INGEST_BATCH_SIZE):
+    items = list(items)
+    for pos in xrange(0, len(items), size):
+        yield items[pos:pos + size]
+
+
+def _sync_through(through, field, entity_ids, pairs):
+    '''Add and delete rows of an Entity many to many through table so that
+    the (entity, related object) pairs of entity_ids are exactly pairs'''
+    to_add = set(pairs)
+    to_delete = []
+    for chunk in _chunks(entity_ids):
+        for pk, entity_id, related_id in through.objects.filter(entity_id__in=chunk).values_list('id', 'entity_id', field):
+            if (entity_id, related_id) in to_add:
+                to_add.remove((entity_id, related_id))
+            else:
+                to_delete.append(pk)
+
+    for chunk in _chunks(to_delete):
+        through.objects.filter(id__in=chunk).delete()
+    through.objects.bulk_create([through(**{'entity_id': entity_id, field: related_id})
+                                 for entity_id, related_id in to_add], batch_size=INGEST_BATCH_SIZE)
+
+
 def update_obj(mobj, obj, attrs=None):
     for_attrs = attrs or getattr(mobj, 'all_attrs', [])
     for attrb in attrs or for_attrs:
@@ -140,6 +189,9 @@ class Base(models.Model):
     editor_users = models.ManyToManyField(User, null=True, blank=True,
                                           verbose_name=_('editor users'))
 
+    metadata_sources = GenericRelation('MetadataSource')
+    metadata_digests = GenericRelation('MetadataDigest')
+
     class Meta(object):
         abstract = True
 
@@ -154,36 +206,80 @@ class Base(models.Model):
             #Only load file and parse it, don't create/update any objects
             if not self.file:
                 return None
-            self._loaded_file = MetadataParser(filename=self.file.path)
+            self._loaded_file = MetadataParser(filename=self.file.path, workers=PARSER_WORKERS,
+                                               parallel_min_size=PARSER_PARALLEL_MIN_SIZE,
+                                               content_digest=self._stored_file_digest())
         return self._loaded_file
 
-    def _get_metadata_stream(self, load_streams):
-        try:
-            load = []
-            select = []
-
-            count = 1
-            for stream in load_streams:
-                curid = "%s%d" % (self.slug, count)
-                load.append("%s as %s" % (stream[0], curid))
-                if stream[1] == 'SP' or stream[1] == 'IDP':
-                    select.append("%s!//md:EntityDescriptor[md:%sSSODescriptor]" % (curid, stream[1]))
-                else:
-                    select.append("%s" % curid)
-                count = count + 1
+    def _pyff_select(self, load_streams, output):
+        # pyff is only imported for the pipelines the native one can not run
+        from pyff.mdrepo import MDRepository
+        from pyff.pipes import Plumbing
+
+        load = []
+        select = []
 
-            if len(select) > 0:
-                pipeline = [{'load': load}, {'select': select}]
+        count = 1
+        for stream in load_streams:
+            curid = "%s%d" % (self.slug, count)
+            load.append("%s as %s" % (stream[0], curid))
+            if stream[1] == 'SP' or stream[1] == 'IDP':
+                select.append("%s!//md:EntityDescriptor[md:%sSSODescriptor]" % (curid, stream[1]))
             else:
-                pipeline = [{'load': load}, 'select']
+                select.append("%s" % curid)
+            count = count + 1
 
-            md = MDRepository()
-            entities = Plumbing(pipeline=pipeline, id=self.slug).process(md, state={'batch': True, 'stats': {}})
-            return etree.tostring(entities)
+        if len(select) > 0:
+            pipeline = [{'load': load}, {'select': select}]
+        else:
+            pipeline = [{'load': load}, 'select']
+
+        md = MDRepository()
+        entities = Plumbing(pipeline=pipeline, id=self.slug).process(md, state={'batch': True, 'stats': {}})
+        etree.ElementTree(entities).write(output)
+
+    def _get_metadata_stream(self, load_streams, filename):
+        '''Write the metadata selected from load_streams to filename and
+        return its SHA-256'''
+        try:
+            with open(filename, 'wb') as metadata_file:
+                output = DigestFile(metadata_file)
+                if METADATA_NATIVE_PIPELINE and can_select(load_streams):
+                    select_entities(load_streams, output, self.slug)
+                else:
+                    self._pyff_select(load_streams, output)
+            return output.hexdigest()
         except Exception, e:
             raise Exception('Getting metadata from %s failed.\nError: %s' % (load_streams, e))
 
-    def fetch_metadata_file(self, file_name):
+    def _stored_file_digest(self):
+        '''Return the SHA-256 stored for the metadata file, if any'''
+        if not self.pk or not self.file:
+            return None
+        return self.metadata_digests.filter(file_name=self.file.name).values_list('sha256', flat=True).first()
+
+    def _get_file_digest(self):
+        '''Return the SHA-256 of the uncompressed metadata file'''
+        if not self.file:
+            return None
+
+        digest = self._stored_file_digest()
+        if digest is None:
+            # Stored before the digests were, or replaced by an upload
+            with open_metadata(self.file.path) as metadata_file:
+                return file_digest(metadata_file)
+        return digest
+
+    def _set_file_digest(self, sha256):
+        if not self.pk:
+            return
+
+        content_type = ContentType.objects.get_for_model(self)
+        MetadataDigest.objects.update_or_create(content_type=content_type, object_id=self.pk,
+                                                defaults={'file_name': self.file.name, 'sha256': sha256})
+
+    def fetch_metadata_file(self, report=None):
+        report = report or RefreshReport()
         file_url = self.file_url
         if not file_url or file_url == '':
             return
@@ -196,26 +292,174 @@ class Base(models.Model):
                 cursource.append("All")
             metadata_files.append(cursource)
 
-        req = self._get_metadata_stream(metadata_files)
-
+        # Everything is streamed through temporary files, so that the
+        # memory used does not depend on the size of the metadata
+        directory = tempfile.mkdtemp()
         try:
-            self.file.seek(0)
-            original_file_content = self.file.read()
-            if compare_filecontents(original_file_content, req):
-                return False
-        except Exception:
-            pass
-
-        filename = path.basename("%s-metadata.xml" % file_name)
-        self.file.delete(save=False)
-        self.file.save(filename, ContentFile(req), save=False)
+            with report.stage('fetch'):
+                downloads = self._download_sources(metadata_files, directory)
+                if downloads is None:
+                    # None of the sources changed since the last fetch
+                    return False
+                load_streams, validators, report.bytes_fetched = downloads
+                metadata_name = path.join(directory, 'metadata.xml')
+                sha256 = self._get_metadata_stream(load_streams, metadata_name)
+
+            with report.stage('compare'):
+                try:
+                    stored_sha256 = self._get_file_digest()
+                except Exception:
+                    # The file is fetched again as if it had changed
+                    logger.exception('Digest of the metadata file of %s could not be computed', self)
+                    stored_sha256 = None
+                if sha256 == stored_sha256:
+                    self._fetched_metadata = (sha256, validators)
+                    if self._file_saved():
+                        self.save_fetched_metadata()
+                    return False
+
+            # Federations fetching the same document share its stored copy
+            name = blob_name(sha256, METADATA_COMPRESSION)
+            if not default_storage.exists(name):
+                if METADATA_COMPRESSION:
+                    compressed_name = metadata_name + COMPRESSION_SUFFIXES[METADATA_COMPRESSION]
+                    with open(metadata_name, 'rb') as metadata_file:
+                        compress_file(metadata_file, compressed_name, METADATA_COMPRESSION)
+                    metadata_name = compressed_name
+                store_blob(name, metadata_name)
+
+            if self.file and not is_blob(self.file.name):
+                # Removed once the object is saved with the new file. Blobs
+                # are only removed by the garbage collection.
+                self._replaced_file = self.file.name
+            self.file = name
+        finally:
+            shutil.rmtree(directory)
+
+        # The new file is parsed, and indexed, from its stored copy
+        if hasattr(self, '_loaded_file'):
+            del self._loaded_file
+        if hasattr(self, '_metadata_cache'):
+            del self._metadata_cache
+
+        # Only stored once the new file is saved, see save_fetched_metadata
+        self._fetched_metadata = (sha256, validators)
         return True
 
+    def _file_saved(self):
+        return bool(self.pk) and type(self).objects.filter(pk=self.pk, file=self.file.name).exists()
+
+    def save_fetched_metadata(self):
+        '''Store the digest and the source validators of the file fetched
+        last, now that the object references it, and remove the file it
+        replaced
+
+        Stored earlier, a failed save would leave validators that make
+        every later fetch answer 304 for a file that was never saved.
+        '''
+        replaced = getattr(self, '_replaced_file', None)
+        if replaced and replaced != self.file.name:
+            del self._replaced_file
+            remove_index(default_storage.path(replaced))
+            default_storage.delete(replaced)
+
+        if not hasattr(self, '_fetched_metadata'):
+            return
+        sha256, validators = self._fetched_metadata
+        del self._fetched_metadata
+        self._set_file_digest(sha256)
+        self._save_sources(validators)
+
+    def _download_sources(self, metadata_files, directory):
+        '''Download the remote sources into directory for pyff, which
+        then only selects the entities from the local copies
+
+        The sources are fetched concurrently, so the time taken is that of
+        the slowest one. Return None if every source answered 304 Not
+        Modified, otherwise the pyff load streams, the validators of the
+        remote sources and the number of bytes downloaded.
+        '''
+        stored = {}
+        if self.pk and self.file and path.exists(self.file.path):
+            # Validators of the sources listed in another file_url, such as
+            # with other selectors, tell nothing about the stored file
+            stored = dict((source.url, source) for source in self.metadata_sources.all()
+                          if source.file_url == self.file_url)
+
+        remote = sorted(set(url for url, _ in metadata_files if is_remote(url)))
+        filenames = dict((url, path.join(directory, 'source%d.xml' % num)) for num, url in enumerate(remote))
+        downloaded = {}
+        validators = {}
+        # The stored file can only be kept if every source can tell it has not changed
+        if remote and len(remote) == len(metadata_files) and set(remote).issubset(stored):
+            results = fetch_sources([(url, filenames[url], stored[url].etag, stored[url].last_modified)
+                                     for url in remote])
+            for url, (size, etag, last_modified) in zip(remote, results):
+                validators[url] = (etag, last_modified)
+                if size is not None:
+                    downloaded[url] = size
+            if not downloaded:
+                return None
+
+        missing = [url for url in remote if url not in downloaded]
+        results = fetch_sources([(url, filenames[url], None, None) for url in missing])
+        for url, (size, etag, last_modified) in zip(missing, results):
+            downloaded[url] = size
+            validators[url] = (etag, last_modified)
+
+        load_streams = [[filenames.get(url, url), selector] for url, selector in metadata_files]
+        return load_streams, validators, sum(downloaded.values())
+
+    def _save_sources(self, validators):
+        if not self.pk:
+            return
+
+        content_type = ContentType.objects.get_for_model(self)
+        self.metadata_sources.exclude(url__in=validators.keys()).delete()
+        for url, (etag, last_modified) in validators.iteritems():
+            MetadataSource.objects.update_or_create(content_type=content_type, object_id=self.pk, url=url,
+                                                    defaults={'etag': etag, 'last_modified': last_modified,
+                                                              'file_url': self.file_url})
+
     @classmethod
     def process_metadata(cls):
         raise NotImplementedError()
 
 
+class MetadataSource(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    owner = GenericForeignKey('content_type', 'object_id')
+    url = models.CharField(max_length=1000, blank=False, null=False,
+                           verbose_name=_(u'Metadata url'))
+    file_url = models.CharField(max_length=1000, blank=False, null=False,
+                                verbose_name=_(u'Sources fetched with'))
+    etag = models.CharField(max_length=200, blank=True, null=True,
+                            verbose_name=_(u'ETag'))
+    last_modified = models.CharField(max_length=100, blank=True, null=True,
+                                     verbose_name=_(u'Last-Modified'))
+    fetched = models.DateTimeField(auto_now=True, verbose_name=_(u'Fetched'))
+
+    def __unicode__(self):
+        return self.url
+
+
+class MetadataDigest(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    owner = GenericForeignKey('content_type', 'object_id')
+    file_name = models.CharField(max_length=100, blank=False, null=False,
+                                 verbose_name=_(u'Metadata file'))
+    sha256 = models.CharField(max_length=64, blank=False, null=False,
+                              verbose_name=_(u'SHA-256'))
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+    def __unicode__(self):
+        return self.sha256
+
+
 class XmlDescriptionError(Exception):
     pass
 
@@ -273,32 +517,53 @@ class Federation(Base):
         if not metadata.is_federation:
             raise XmlDescriptionError("XML Haven't federation form")
 
-        update_obj(metadata.get_federation(), self)
-
-    def _remove_deleted_entities(self, entities_from_xml, request):
-        entities_to_remove = []
-        for entity in self.entity_set.all():
-            #Remove entity relation if does not exist in metadata
-            if not entity.entityid in entities_from_xml:
-                entities_to_remove.append(entity)
-
-        if len(entities_to_remove) > 0:
-            self.entity_set.remove(*entities_to_remove)
+        # Store the entity index next to the file for the web workers
+        metadata.prepare_index()
 
-            if request:
-                for entity in entities_to_remove:
-                    if not entity.federations.exists():
-                        messages.warning(request,
-                                         mark_safe(_("Orphan entity: <a href='%s'>%s</a>" %
-                                         (entity.get_absolute_url(), entity.entityid))))
-
-        return len(entities_to_remove)
+        update_obj(metadata.get_federation(), self)
 
-    def _update_entities(self, entities_to_update, entities_to_add):
-        for e in entities_to_update:
-            e.save()
+    def remove_entities(self, entity_ids, delete_orphans=False):
+        '''Detach the entities from the federation and return those left
+        without any federation, deleting them if delete_orphans is set'''
+        through = Entity.federations.through
+        for chunk in _chunks(entity_ids):
+            through.objects.filter(federation=self, entity_id__in=chunk).delete()
+            EntityDigest.objects.filter(federation=self, entity_id__in=chunk).delete()
+
+        orphans = Entity.get_orphans(entity_ids)
+        if delete_orphans:
+            for chunk in _chunks(orphans):
+                Entity.objects.filter(id__in=[entity.id for entity in chunk]).delete()
+        return orphans
+
+    def _stage_deleted_entities(self, entities_from_xml):
+        '''Stage the removal of the entities no longer in the metadata'''
+        entities_to_remove = [pk for pk, entityid in self.entity_set.values_list('id', 'entityid')
+                              if entityid not in entities_from_xml]
+        StagedEntity.objects.bulk_create([StagedEntity(federation=self, entity_id=pk, removed=True)
+                                          for pk in entities_to_remove], batch_size=INGEST_BATCH_SIZE)
+        return entities_to_remove
 
-        self.entity_set.add(*entities_to_add)
+    @staticmethod
+    def _create_entities(entities_to_create):
+        created = []
+        for chunk in _chunks(entities_to_create):
+            try:
+                with transaction.atomic():
+                    Entity.objects.bulk_create(chunk)
+            except IntegrityError:
+                # Some of them have been added by another federation meanwhile
+                for entity in chunk:
+                    Entity.objects.get_or_create(entityid=entity.entityid,
+                                                 defaults={'name': entity.name,
+                                                           'registration_authority': entity.registration_authority})
+
+            # bulk_create does not set the primary keys
+            entities_data = dict((entity.entityid, entity._entity_cached) for entity in chunk)
+            for entity in Entity.objects.filter(entityid__in=entities_data.keys()):
+                entity._entity_cached = entities_data[entity.entityid]
+                created.append(entity)
+        return created
 
     @staticmethod
     def _entity_has_changed(entity, entityid, name, registration_authority):
@@ -311,38 +576,124 @@ class Federation(Base):
 
         return False
 
-    def _add_new_entities(self, entities, entities_from_xml, request, federation_slug):
-        db_entity_types = EntityType.objects.all()
-        cached_entity_types = { entity_type.xmlname: entity_type for entity_type in db_entity_types }
-
+    def _stage_entities(self, entities, entityids, progress):
+        '''Parse the entities to process and return, without writing to the
+        database, those to create, to update and to add to the federation'''
         entities_to_add = []
+        entities_to_create = []
         entities_to_update = []
+        processed = set()
 
-        for m_id in entities_from_xml:
-            if request and federation_slug:
-                request.session['%s_cur_entities' % federation_slug] += 1
-                request.session.save()
+        for entity_from_xml in self._metadata.iter_entities(details=False, entityids=entityids):
+            m_id = entity_from_xml['entityid']
+            if m_id in processed:
+                continue
+            processed.add(m_id)
 
-            created = False
-            if m_id in entities:
-                entity = entities[m_id]
-            else:
-                entity, created = Entity.objects.get_or_create(entityid=m_id)
+            progress.update(progress.current + 1)
+
+            if m_id not in entities:
+                entity = Entity(entityid=m_id)
+                entity.process_fields(entity_from_xml)
+                entities_to_create.append(entity)
+                continue
 
+            entity = entities[m_id]
             entityid = entity.entityid
             name = entity.name
             registration_authority = entity.registration_authority
- 
-            entity_from_xml = self._metadata.get_entity(m_id, True)
-            entity.process_metadata(False, entity_from_xml, cached_entity_types)
 
-            if created or self._entity_has_changed(entity, entityid, name, registration_authority):
+            entity.process_metadata(False, entity_from_xml, False)
+
+            if self._entity_has_changed(entity, entityid, name, registration_authority):
                 entities_to_update.append(entity)
 
             entities_to_add.append(entity)
 
-        self._update_entities(entities_to_update, entities_to_add)
-        return len(entities_to_update) 
+        return entities_to_create, entities_to_update, entities_to_add
+
+    def _write_staging(self, entities_to_create, entities_to_update, entities_to_add, digests, registry):
+        '''Create the new entities and write the staged rows of all of them,
+        which stay invisible to the federation until _publish_staged. Return
+        the number of entities updated and added to the federation.'''
+        created = self._create_entities(entities_to_create)
+        entities = entities_to_add + created
+        federation_entities = set()
+        for chunk in _chunks([entity.pk for entity in entities]):
+            federation_entities.update(self.entity_set.filter(id__in=chunk).values_list('id', flat=True))
+        changed = set(entity.pk for entity in entities_to_update)
+
+        StagedEntity.objects.bulk_create([StagedEntity(federation=self, entity=entity, digest=digests[entity.entityid],
+                                                       name=entity.name, changed=entity.pk in changed,
+                                                       registration_authority=entity.registration_authority)
+                                          for entity in entities], batch_size=INGEST_BATCH_SIZE)
+        StagedRelation.objects.bulk_create([StagedRelation(federation=self, entity_id=entity_id,
+                                                           relation=relation, related_id=related_id)
+                                            for relation, pairs in Entity.relation_pairs(entities, registry).items()
+                                            for entity_id, related_id in pairs], batch_size=INGEST_BATCH_SIZE)
+        return len(entities_to_update), len([entity for entity in entities if entity.pk not in federation_entities])
+
+    def _publish_staged(self):
+        '''Swap the staged rows of the federation in. The statements copy
+        them between tables, so their number does not grow with the batch.'''
+        qn = connection.ops.quote_name
+        tables = {
+            'entity': qn(Entity._meta.db_table),
+            'digest': qn(EntityDigest._meta.db_table),
+            'staged': qn(StagedEntity._meta.db_table),
+            'relation': qn(StagedRelation._meta.db_table),
+        }
+        statements = [
+            ("UPDATE %(entity)s SET "
+             "name = (SELECT name FROM %(staged)s WHERE entity_id = %(entity)s.id AND federation_id = %%s), "
+             "registration_authority = (SELECT registration_authority FROM %(staged)s "
+             "WHERE entity_id = %(entity)s.id AND federation_id = %%s) "
+             "WHERE id IN (SELECT entity_id FROM %(staged)s WHERE federation_id = %%s AND changed = %%s)" % tables,
+             [self.pk, self.pk, self.pk, True]),
+            ("DELETE FROM %(digest)s WHERE federation_id = %%s AND "
+             "entity_id IN (SELECT entity_id FROM %(staged)s WHERE federation_id = %%s)" % tables,
+             [self.pk, self.pk]),
+            ("INSERT INTO %(digest)s (entity_id, federation_id, digest) "
+             "SELECT entity_id, federation_id, digest FROM %(staged)s "
+             "WHERE federation_id = %%s AND removed = %%s" % tables,
+             [self.pk, False]),
+        ]
+
+        field = Entity._meta.get_field('federations')
+        through = dict(tables, through=qn(field.rel.through._meta.db_table),
+                       entity_id=qn(field.m2m_column_name()), related_id=qn(field.m2m_reverse_name()))
+        statements += [
+            ("DELETE FROM %(through)s WHERE %(related_id)s = %%s AND %(entity_id)s IN "
+             "(SELECT entity_id FROM %(staged)s WHERE federation_id = %%s AND removed = %%s)" % through,
+             [self.pk, self.pk, True]),
+            ("INSERT INTO %(through)s (%(entity_id)s, %(related_id)s) "
+             "SELECT entity_id, federation_id FROM %(staged)s WHERE federation_id = %%s AND removed = %%s "
+             "AND entity_id NOT IN (SELECT %(entity_id)s FROM %(through)s WHERE %(related_id)s = %%s)" % through,
+             [self.pk, False, self.pk]),
+        ]
+
+        for relation in ('types', 'entity_categories'):
+            field = Entity._meta.get_field(relation)
+            through = dict(tables, through=qn(field.rel.through._meta.db_table),
+                           entity_id=qn(field.m2m_column_name()), related_id=qn(field.m2m_reverse_name()))
+            statements += [
+                ("DELETE FROM %(through)s WHERE %(entity_id)s IN "
+                 "(SELECT entity_id FROM %(staged)s WHERE federation_id = %%s AND removed = %%s)" % through,
+                 [self.pk, False]),
+                ("INSERT INTO %(through)s (%(entity_id)s, %(related_id)s) "
+                 "SELECT entity_id, related_id FROM %(relation)s "
+                 "WHERE federation_id = %%s AND relation = %%s" % through,
+                 [self.pk, relation]),
+            ]
+
+        statements += [
+            ("DELETE FROM %(relation)s WHERE federation_id = %%s" % tables, [self.pk]),
+            ("DELETE FROM %(staged)s WHERE federation_id = %%s" % tables, [self.pk]),
+        ]
+
+        cursor = connection.cursor()
+        for sql, params in statements:
+            cursor.execute(sql, params)
 
     @staticmethod
     def _daterange(start_date, end_date):
@@ -350,10 +701,15 @@ class Federation(Base):
             yield start_date + timedelta(n)
 
     def compute_new_stats(self):
-        entities_from_xml = self._metadata.get_entities()
+        entities_from_xml = {}
+        for entity_from_xml in self._metadata.iter_entities(details=False):
+            entities_from_xml.setdefault(entity_from_xml['entityid'], entity_from_xml)
 
-        entities = Entity.objects.filter(entityid__in=entities_from_xml)
-        entities = entities.prefetch_related('types')
+        entities = Entity.objects.filter(entityid__in=entities_from_xml.keys())
+        entities = list(entities.prefetch_related('types'))
+        for entity in entities:
+            if entity.entityid in entities_from_xml:
+                entity.load_metadata(entity_data=entities_from_xml[entity.entityid])
 
         try:
             first_date = EntityStat.objects.filter(federation=self).aggregate(Max('time'))['time__max']
@@ -393,30 +749,67 @@ class Federation(Base):
 
         return (computed, not_computed)
 
-    def process_metadata_entities(self, request=None, federation_slug=None):
-        entities_from_xml = self._metadata.get_entities()
-        removed = self._remove_deleted_entities(entities_from_xml, request)
-
-        entities = {}
-        db_entities = Entity.objects.filter(entityid__in=entities_from_xml)
-        db_entities = db_entities.prefetch_related('types', 'entity_categories')
-
-        for entity in db_entities.all():
-            entities[entity.entityid] = entity
+    def process_metadata_entities(self, request=None, report=None):
+        entities_from_xml = self._metadata.get_entity_digests()
+
+        # Only the entities new to the federation or whose EntityDescriptor
+        # changed since the last run have to be processed
+        stored_digests = dict(EntityDigest.objects.filter(federation=self).values_list('entity__entityid', 'digest'))
+        federation_entities = set(self.entity_set.values_list('entityid', flat=True))
+        entities_to_process = set(entityid for entityid, digest in entities_from_xml.iteritems()
+                                  if entityid not in federation_entities or stored_digests.get(entityid) != digest)
+
+        progress = ProgressReporter(self)
+        progress.start(len(entities_to_process))
+        registry = ReferenceRegistry()
+
+        checkpoint = None
+        batches = [entities_to_process]
+        if INGEST_CHECKPOINT_SIZE and len(entities_to_process) > INGEST_CHECKPOINT_SIZE:
+            # Commit very large ingests in batches that a restarted run skips
+            checkpoint = IngestCheckpoint.resume(self, entities_from_xml)
+            batches = checkpoint.batches(entities_to_process, INGEST_CHECKPOINT_SIZE)
+
+        # Left over by a run that failed before publishing
+        StagedRelation.objects.filter(federation=self).delete()
+        StagedEntity.objects.filter(federation=self).delete()
+
+        updated = added = 0
+        for num, batch in enumerate(batches):
+            entities = {}
+            for chunk in _chunks(batch):
+                for entity in Entity.objects.filter(entityid__in=chunk):
+                    entities[entity.entityid] = entity
+            staged = self._stage_entities(entities, batch, progress)
+            batch_updated, batch_added = self._write_staging(*staged, digests=entities_from_xml, registry=registry)
+            last = num == len(batches) - 1
+            if last:
+                removed = self._stage_deleted_entities(entities_from_xml)
+
+            # Readers see either the old or the new federation (or batch),
+            # and a failure leaves it untouched
+            with transaction.atomic():
+                self._publish_staged()
+                if last:
+                    IngestCheckpoint.objects.filter(federation=self).delete()
+                else:
+                    checkpoint.commit()
 
-        if request and federation_slug:
-            request.session['%s_num_entities' % federation_slug] = len(entities_from_xml)
-            request.session['%s_cur_entities' % federation_slug] = 0
-            request.session['%s_process_done' % federation_slug] = False
-            request.session.save()
+            updated += batch_updated
+            added += batch_added
 
-        updated = self._add_new_entities(entities, entities_from_xml, request, federation_slug)
+        if request:
+            for entity in Entity.get_orphans(removed):
+                messages.warning(request,
+                                 mark_safe(_("Orphan entity: <a href='%s'>%s</a>" %
+                                 (entity.get_absolute_url(), entity.entityid))))
 
-        if request and federation_slug:
-            request.session['%s_process_done' % federation_slug] = True
-            request.session.save()
+        removed = len(removed)
+        progress.finish()
+        if report:
+            report.entities_removed, report.entities_updated, report.entities_added = removed, updated, added
 
-        return removed, updated
+        return removed, updated + added
 
     def get_absolute_url(self):
         return reverse('federation_view', args=[self.slug])
@@ -554,7 +947,7 @@ class EntityType(models.Model):
 
 class EntityCategory(models.Model):
     category_id = models.CharField(verbose_name='Entity category ID',
-                                max_length=1000,
+                                max_length=1000, unique=True,
                                 blank=False, null=False,
                                 help_text=_(u'The ID of the entity category'))
     name = models.CharField(verbose_name='Entity category name',
@@ -787,63 +1180,67 @@ class Entity(Base):
         else:
             raise ValueError("Not metadata loaded")
 
-    def _get_or_create_etypes(self, cached_entity_types):
-        entity_types = []
-        cur_cached_types = [t.xmlname for t in self.types.all()]
-        for etype in self.xml_types:
-            if etype in cur_cached_types:
-               break
+    @staticmethod
+    def get_orphans(entity_ids):
+        '''Return the entities of entity_ids that belong to no federation'''
+        orphans = []
+        for chunk in _chunks(entity_ids):
+            entities = Entity.objects.filter(id__in=chunk).annotate(num_federations=Count('federations'))
+            orphans.extend(entities.filter(num_federations=0))
+        return orphans
 
-            if cached_entity_types is None:
-                entity_type, _ = EntityType.objects.get_or_create(xmlname=etype,
-                                                                  name=DESCRIPTOR_TYPES_DISPLAY[etype])
-            else:
-                if etype in cached_entity_types:
-                    entity_type = cached_entity_types[etype]
-                else:
-                    entity_type = EntityType.objects.create(xmlname=etype,
-                                                            name=DESCRIPTOR_TYPES_DISPLAY[etype])
-            entity_types.append(entity_type)
-        return entity_types
-
-    def _get_or_create_ecategories(self, cached_entity_categories):
-        entity_categories = []
-        cur_cached_categories = [t.category_id for t in self.entity_categories.all()]
-        for ecategory in self.xml_categories:
-            if ecategory in cur_cached_categories:
-                break
-
-            if cached_entity_categories is None:
-                entity_category, _ = EntityCategory.objects.get_or_create(category_id=ecategory)
-            else:
-                if ecategory in cached_entity_categories:
-                    entity_category = cached_entity_categories[ecategory]
-                else:
-                    entity_category = EntityCategory.objects.create(category_id=ecategory)
-            entity_categories.append(entity_category)
-        return entity_categories
+    @staticmethod
+    def relation_pairs(entities, registry):
+        '''Return the (entity, related object) pairs wanted for the entities
+        by relation, creating the types and categories missing'''
+        entities_types = [(entity.pk, entity.xml_types or []) for entity in entities]
+        entities_categories = [(entity.pk, entity.xml_categories or []) for entity in entities]
+        registry.ensure(set(etype for _, etypes in entities_types for etype in etypes),
+                        set(ecategory for _, ecategories in entities_categories for ecategory in ecategories))
+
+        return {
+            'types': set((entity_id, registry.entity_types[etype].pk)
+                         for entity_id, etypes in entities_types for etype in etypes),
+            'entity_categories': set((entity_id, registry.entity_categories[ecategory].pk)
+                                     for entity_id, ecategories in entities_categories for ecategory in ecategories),
+        }
+
+    @classmethod
+    def sync_relations(cls, entities, registry=None):
+        '''Make the types and categories of the entities match their metadata
 
-    def process_metadata(self, auto_save=True, entity_data=None, cached_entity_types=None):
+        The pairs wanted for all the entities are diffed against the through
+        tables at once, so only the differences are written.
+        '''
+        if registry is None:
+            registry = ReferenceRegistry()
+
+        pairs = cls.relation_pairs(entities, registry)
+        entity_ids = [entity.pk for entity in entities]
+        _sync_through(cls.types.through, 'entitytype_id', entity_ids, pairs['types'])
+        _sync_through(cls.entity_categories.through, 'entitycategory_id', entity_ids, pairs['entity_categories'])
+
+    def process_metadata(self, auto_save=True, entity_data=None, sync_relations=True):
         if not entity_data:
             self.load_metadata()
+            entity_data = self._entity_cached
 
         if self.entityid.lower() != entity_data.get('entityid').lower():
             raise ValueError("EntityID is not the same: %s != %s" % (self.entityid.lower(), entity_data.get('entityid').lower()))
 
         self._entity_cached = entity_data
 
-        if self.xml_types:
-            entity_types = self._get_or_create_etypes(cached_entity_types)
-            if len(entity_types) > 0:
-                self.types.add(*entity_types)
+        if sync_relations:
+            Entity.sync_relations([self])
+
+        self.process_fields(entity_data)
 
-        if self.xml_categories:
-            db_entity_categories = EntityCategory.objects.all()
-            cached_entity_categories = { entity_category.category_id: entity_category for entity_category in db_entity_categories }
+        if auto_save:
+            self.save()
 
-            entity_categories = self._get_or_create_ecategories(cached_entity_categories)
-            if len(entity_categories) > 0:
-                self.entity_categories.add(*entity_categories)
+    def process_fields(self, entity_data):
+        '''Update the fields of the entity, but none of its relations'''
+        self._entity_cached = entity_data
 
         newname = self._get_property('displayName')
         if newname and newname != '':
@@ -852,9 +1249,6 @@ class Entity(Base):
         if str(self._get_property('registration_authority')) != '':
             self.registration_authority = self._get_property('registration_authority')
 
-        if auto_save:
-            self.save()
-
     def to_dict(self):
         self.load_metadata()
 
@@ -920,6 +1314,91 @@ class Entity(Base):
         return False
 
 
+class ReferenceRegistry(object):
+    '''EntityType and EntityCategory rows for the length of one ingest run
+
+    Both tables are read once and the missing rows are created in bulk.
+    '''
+
+    def __init__(self):
+        self.entity_types = dict((entity_type.xmlname, entity_type) for entity_type in EntityType.objects.all())
+        self.entity_categories = dict((category.category_id, category) for category in EntityCategory.objects.all())
+
+    def ensure(self, xmlnames, category_ids):
+        '''Create the entity types and categories not in the database yet'''
+        missing_types = set(xmlnames) - set(self.entity_types)
+        if missing_types:
+            try:
+                with transaction.atomic():
+                    EntityType.objects.bulk_create([EntityType(xmlname=xmlname, name=DESCRIPTOR_TYPES_DISPLAY[xmlname])
+                                                    for xmlname in missing_types])
+            except IntegrityError:
+                # Created by a concurrent ingest
+                pass
+            for entity_type in EntityType.objects.filter(xmlname__in=missing_types):
+                self.entity_types[entity_type.xmlname] = entity_type
+
+        missing_categories = set(category_ids) - set(self.entity_categories)
+        if missing_categories:
+            try:
+                with transaction.atomic():
+                    EntityCategory.objects.bulk_create([EntityCategory(category_id=category_id)
+                                                        for category_id in missing_categories])
+            except IntegrityError:
+                # Created by a concurrent ingest
+                pass
+            for category in EntityCategory.objects.filter(category_id__in=missing_categories):
+                self.entity_categories[category.category_id] = category
+
+
+class EntityDigest(models.Model):
+    entity = models.ForeignKey(Entity, blank=False,
+                               verbose_name=_(u'Entity'))
+    federation = models.ForeignKey(Federation, blank=False,
+                                   verbose_name=_(u'Federation'))
+    digest = models.CharField(max_length=40, blank=False, null=False,
+                              verbose_name=_(u'EntityDescriptor digest'))
+
+    class Meta:
+        unique_together = ('entity', 'federation')
+
+    def __unicode__(self):
+        return self.digest
+
+
+class StagedEntity(models.Model):
+    '''Entity of a federation written by an ingest run and not published yet'''
+    federation = models.ForeignKey(Federation, blank=False,
+                                   verbose_name=_(u'Federation'))
+    entity = models.ForeignKey(Entity, blank=False,
+                               verbose_name=_(u'Entity'))
+    digest = models.CharField(max_length=40, blank=True,
+                              verbose_name=_(u'EntityDescriptor digest'))
+    name = JSONField(blank=True, null=True, max_length=2000,
+                     verbose_name=_(u'Display Name'))
+    registration_authority = models.CharField(max_length=200, blank=True, null=True,
+                                              verbose_name=_('Registration Authority'))
+    changed = models.BooleanField(default=False, verbose_name=_(u'Changed'))
+    removed = models.BooleanField(default=False, verbose_name=_(u'Removed'))
+
+    def __unicode__(self):
+        return u'%s %s' % (self.federation_id, self.entity_id)
+
+
+class StagedRelation(models.Model):
+    '''Type or category of a staged entity'''
+    federation = models.ForeignKey(Federation, blank=False,
+                                   verbose_name=_(u'Federation'))
+    entity = models.ForeignKey(Entity, blank=False,
+                               verbose_name=_(u'Entity'))
+    relation = models.CharField(max_length=20, blank=False,
+                                verbose_name=_(u'Relation'))
+    related_id = models.PositiveIntegerField(verbose_name=_(u'Related object'))
+
+    def __unicode__(self):
+        return u'%s %s' % (self.relation, self.related_id)
+
+
 class EntityStat(models.Model):
     time = models.DateTimeField(blank=False, null=False, 
                            verbose_name=_(u'Metadata time stamp'))
@@ -936,6 +1415,324 @@ class EntityStat(models.Model):
         return self.feature
 
 
+class IngestCheckpoint(models.Model):
+    federation = models.OneToOneField(Federation, blank=False,
+                                      verbose_name=_(u'Federation'))
+    file_digest = models.CharField(max_length=40, blank=False, null=False,
+                                   verbose_name=_(u'Metadata digest'))
+    batch = models.PositiveIntegerField(default=0, verbose_name=_(u'Next batch'))
+    updated = models.DateTimeField(auto_now=True, verbose_name=_(u'Updated'))
+
+    def __unicode__(self):
+        return u'%s batch %s' % (self.federation, self.batch)
+
+    @staticmethod
+    def _digest(digests):
+        sha1 = hashlib.sha1()
+        for entityid in sorted(digests):
+            sha1.update(entityid.encode('utf-8'))
+            sha1.update(digests[entityid])
+        return sha1.hexdigest()
+
+    @classmethod
+    def resume(cls, federation, digests):
+        '''Return the checkpoint of the federation, starting over if it was
+        taken on another metadata file'''
+        file_digest = cls._digest(digests)
+        checkpoint, _ = cls.objects.get_or_create(federation=federation, defaults={'file_digest': file_digest})
+        if checkpoint.file_digest != file_digest:
+            checkpoint.file_digest = file_digest
+            checkpoint.batch = 0
+            checkpoint.save()
+        checkpoint.entityids = sorted(digests)
+        return checkpoint
+
+    def batches(self, entityids, size):
+        '''Split entityids in the batches left to process. The batches are
+        cut over every entity of the file, so that they do not change
+        between runs on the same file.'''
+        batches = []
+        for num, chunk in enumerate(_chunks(self.entityids, size)):
+            if num >= self.batch:
+                batches.append([entityid for entityid in chunk if entityid in entityids])
+        return batches or [[]]
+
+    def commit(self):
+        self.batch += 1
+        self.save(update_fields=['batch', 'updated'])
+
+
+class IngestProgress(models.Model):
+    federation = models.OneToOneField(Federation, blank=False,
+                                      verbose_name=_(u'Federation'))
+    total = models.PositiveIntegerField(default=0, verbose_name=_(u'Entities to process'))
+    current = models.PositiveIntegerField(default=0, verbose_name=_(u'Processed entities'))
+    done = models.BooleanField(default=False, verbose_name=_(u'Done'))
+
+    def __unicode__(self):
+        return u'%s/%s' % (self.current, self.total)
+
+    def to_dict(self):
+        return {'tot': self.total, 'num': self.current, 'done': self.done}
+
+
+def _shared_cache():
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    # Other processes cannot read what is stored in these
+    return not backend.endswith(('LocMemCache', 'DummyCache'))
+
+
+class ProgressReporter(object):
+    '''Publish the progress of a federation ingest to every worker
+
+    The progress is written at most every INGEST_PROGRESS_ENTITIES entities
+    or INGEST_PROGRESS_INTERVAL milliseconds, to the cache when it is shared
+    between processes and to the IngestProgress table otherwise.
+    '''
+
+    def __init__(self, federation, use_cache=None):
+        self.federation = federation
+        self.use_cache = _shared_cache() if use_cache is None else use_cache
+        self.total = 0
+        self.current = 0
+        self._written = 0
+        self._written_time = 0
+
+    @staticmethod
+    def _cache_key(federation):
+        return 'ingest_progress_%s' % federation.id
+
+    def start(self, total):
+        self.total = total
+        self.current = 0
+        self._write(False)
+
+    def update(self, current):
+        self.current = current
+        if (current - self._written >= INGEST_PROGRESS_ENTITIES or current == self.total or
+            (current_time() - self._written_time) * 1000 >= INGEST_PROGRESS_INTERVAL):
+            self._write(False)
+
+    def finish(self):
+        self._write(True)
+
+    def _write(self, done):
+        self._written = self.current
+        self._written_time = current_time()
+        data = {'tot': self.total, 'num': self.current, 'done': done}
+
+        if self.use_cache:
+            try:
+                cache.set(self._cache_key(self.federation), data, INGEST_PROGRESS_TIMEOUT)
+                return
+            except Exception:
+                # The cache server is down, fall back to the database
+                pass
+
+        fields = {'total': self.total, 'current': self.current, 'done': done}
+        if not IngestProgress.objects.filter(federation=self.federation).update(**fields):
+            IngestProgress.objects.create(federation=self.federation, **fields)
+
+    @classmethod
+    def read(cls, federation, use_cache=None):
+        '''Return the last progress written for the federation, or None'''
+        if _shared_cache() if use_cache is None else use_cache:
+            data = cache.get(cls._cache_key(federation))
+            if data is not None:
+                return data
+
+        progress = IngestProgress.objects.filter(federation=federation).first()
+        return progress.to_dict() if progress else None
+
+
+class RefreshReport(models.Model):
+    federation = models.ForeignKey(Federation, blank=False,
+                                   verbose_name=_(u'Federation'))
+    started = models.DateTimeField(db_index=True, default=timezone.now, verbose_name=_(u'Started'))
+    fetch_time = models.FloatField(default=0, verbose_name=_(u'Fetch (s)'))
+    compare_time = models.FloatField(default=0, verbose_name=_(u'Compare (s)'))
+    parse_time = models.FloatField(default=0, verbose_name=_(u'Parse (s)'))
+    entities_time = models.FloatField(default=0, verbose_name=_(u'Entities (s)'))
+    stats_time = models.FloatField(default=0, verbose_name=_(u'Statistics (s)'))
+    total_time = models.FloatField(default=0, verbose_name=_(u'Total (s)'))
+    bytes_fetched = models.BigIntegerField(default=0, verbose_name=_(u'Bytes fetched'))
+    entities_added = models.PositiveIntegerField(default=0, verbose_name=_(u'Entities added'))
+    entities_updated = models.PositiveIntegerField(default=0, verbose_name=_(u'Entities updated'))
+    entities_removed = models.PositiveIntegerField(default=0, verbose_name=_(u'Entities removed'))
+    queries = models.PositiveIntegerField(default=0, verbose_name=_(u'Database queries'))
+    # The process peak RSS never goes down, so only its growth tells what a refresh used
+    peak_rss_growth = models.PositiveIntegerField(default=0, verbose_name=_(u'Peak RSS growth (KB)'))
+    error = models.TextField(blank=True, null=True, verbose_name=_(u'Error'))
+
+    STAGES = ('fetch', 'compare', 'parse', 'entities', 'stats')
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.federation, self.started)
+
+    @contextmanager
+    def stage(self, name):
+        '''Add the time spent in the block to the duration of the stage'''
+        start = current_time()
+        try:
+            yield
+        finally:
+            field = '%s_time' % name
+            setattr(self, field, getattr(self, field) + current_time() - start)
+
+
+JOB_KINDS = (
+    ('update_entities', _(u'Update federation entities')),
+    ('process_metadata', _(u'Process uploaded metadata')),
+)
+
+JOB_STATUSES = (
+    ('pending', _(u'Pending')),
+    ('running', _(u'Running')),
+    ('done', _(u'Done')),
+    ('failed', _(u'Failed')),
+)
+
+
+class IngestJob(models.Model):
+    federation = models.ForeignKey(Federation, blank=False,
+                                   verbose_name=_(u'Federation'))
+    kind = models.CharField(max_length=20, blank=False, null=False, choices=JOB_KINDS,
+                            verbose_name=_(u'Kind'))
+    status = models.CharField(max_length=10, blank=False, null=False, choices=JOB_STATUSES,
+                              default='pending', db_index=True, verbose_name=_(u'Status'))
+    progress_current = models.PositiveIntegerField(default=0, verbose_name=_(u'Processed entities'))
+    progress_total = models.PositiveIntegerField(default=0, verbose_name=_(u'Entities to process'))
+    created = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Created'))
+    started = models.DateTimeField(blank=True, null=True, verbose_name=_(u'Started'))
+    heartbeat = models.DateTimeField(blank=True, null=True, verbose_name=_(u'Last seen running'))
+    finished = models.DateTimeField(blank=True, null=True, verbose_name=_(u'Finished'))
+    result = models.TextField(blank=True, null=True, verbose_name=_(u'Result'))
+    error = models.TextField(blank=True, null=True, verbose_name=_(u'Error'))
+
+    class Meta:
+        ordering = ('created', 'id')
+
+    def __unicode__(self):
+        return u'%s %s (%s)' % (self.kind, self.federation, self.status)
+
+    @classmethod
+    def _reclaim_stale(cls):
+        '''Queue again the running jobs whose worker stopped sending its
+        heartbeat, as a killed worker leaves them running forever'''
+        cutoff = timezone.now() - timedelta(seconds=INGEST_JOB_TIMEOUT)
+        cls.objects.filter(status='running', heartbeat__lt=cutoff).update(status='pending')
+
+    @classmethod
+    def enqueue(cls, federation, kind):
+        '''Queue a job for the worker, reusing one that already covers it'''
+        cls._reclaim_stale()
+        if kind == 'update_entities':
+            # Any queued or running job of the federation updates its entities
+            jobs = cls.objects.filter(federation=federation, status__in=('pending', 'running'))
+        else:
+            jobs = cls.objects.filter(federation=federation, kind=kind, status='pending')
+
+        job = jobs.order_by('-created', '-id').first()
+        if job is None:
+            job = cls.objects.create(federation=federation, kind=kind)
+        return job
+
+    @classmethod
+    def claim(cls):
+        '''Return the oldest pending job after marking it as running, if any'''
+        cls._reclaim_stale()
+        for job in cls.objects.filter(status='pending')[:10]:
+            started = timezone.now()
+            # Only one worker wins the update if several of them race for the job
+            if cls.objects.filter(pk=job.pk, status='pending').update(status='running', started=started,
+                                                                      heartbeat=started):
+                job.status = 'running'
+                job.started = job.heartbeat = started
+                return job
+        return None
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    @property
+    def duration(self):
+        if not self.started:
+            return None
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+
+    @contextmanager
+    def _heartbeat(self):
+        '''Tell, every INGEST_JOB_HEARTBEAT seconds, that the job is still
+        running'''
+        stop = threading.Event()
+
+        def beat():
+            try:
+                while not stop.wait(INGEST_JOB_HEARTBEAT):
+                    IngestJob.objects.filter(pk=self.pk, status='running').update(heartbeat=timezone.now())
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def run(self):
+        federation = self.federation
+        try:
+            # Wait for the refresh script if it is updating the federation
+            with self._heartbeat(), federation_lock(federation):
+                if self.kind == 'process_metadata':
+                    if federation.file_url:
+                        federation.fetch_metadata_file()
+                        federation.save(update_fields=['file'])
+                    federation.process_metadata()
+                removed, updated = federation.process_metadata_entities()
+            self.result = 'Removed %s old entities and updated %s entities.' % (removed, updated)
+            self.status = 'done'
+        except Exception, e:
+            logger.exception('%s job of %s failed', self.kind, federation)
+            self.error = '%s' % e
+            self.status = 'failed'
+
+        progress = ProgressReporter.read(federation)
+        if progress:
+            self.progress_total, self.progress_current = progress['tot'], progress['num']
+        self.finished = timezone.now()
+        self.save()
+
+    def to_dict(self):
+        total, current = self.progress_total, self.progress_current
+        if self.status == 'running':
+            progress = ProgressReporter.read(self.federation) or {}
+            total, current = progress.get('tot', 0), progress.get('num', 0)
+
+        return {
+            'id': self.id,
+            'federation': self.federation.slug,
+            'kind': self.kind,
+            'status': self.status,
+            'done': self.done,
+            'tot': total,
+            'num': current,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'duration': self.duration,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
 class Dummy(models.Model):
     pass
 
@@ -946,16 +1743,25 @@ def federation_pre_save(sender, instance, **kwargs):
     if kwargs.has_key('update_fields') and kwargs['update_fields'] == set(['file']):
         return
 
-    slug = slugify(unicode(instance.name))[:200]
-    if instance.file_url and instance.file_url != '':
-        instance.fetch_metadata_file(slug)
+    # The edit view leaves the download to its process_metadata job
+    if instance.file_url and instance.file_url != '' and not getattr(instance, 'defer_fetch', False):
+        instance.fetch_metadata_file()
     if instance.name:
         instance.slug = slugify(unicode(instance))[:200]
 
 
+@receiver(post_save, sender=Federation, dispatch_uid='federation_post_save')
+def federation_post_save(sender, instance, **kwargs):
+    instance.save_fetched_metadata()
+
+
 @receiver(pre_save, sender=Entity, dispatch_uid='entity_pre_save')
 def entity_pre_save(sender, instance, **kwargs):
     if instance.file_url:
-        slug = slugify(unicode(instance.name))[:200]
-        instance.fetch_metadata_file(slug)
+        instance.fetch_metadata_file()
         instance.process_metadata()
+
+
+@receiver(post_save, sender=Entity, dispatch_uid='entity_post_save')
+def entity_post_save(sender, instance, **kwargs):
+    instance.save_fetched_metadata()
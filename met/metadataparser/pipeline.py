@@ -0,0 +1,111 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+#########################################################################################
+
+from copy import deepcopy
+from os import path
+
+from lxml import etree
+
+from met.metadataparser.compression import open_metadata
+from met.metadataparser.xmlparser import ENTITY_ROOT_TAG, FEDERATION_ROOT_TAG, addns
+
+SELECTORS = {
+    'IDP': addns('IDPSSODescriptor'),
+    'SP': addns('SPSSODescriptor'),
+}
+
+
+def can_select(load_streams):
+    '''Tell if the native pipeline can load every stream, which must be a
+    local file, instead of sending them through pyff'''
+    return all(path.isfile(filename) for filename, _ in load_streams)
+
+
+def _read_root(filename):
+    '''Return the root element of filename with its Extensions only, parsing
+    the file up to its first entity'''
+    with open_metadata(filename) as source:
+        root = None
+        for event, element in etree.iterparse(source, events=('start', 'end'), huge_tree=True,
+                                              remove_blank_text=True):
+            if root is None:
+                root = element
+            elif element.getparent() is not root:
+                continue
+            elif element.tag == addns('Extensions'):
+                if event == 'end':
+                    return root, element
+            elif element.tag in (ENTITY_ROOT_TAG, FEDERATION_ROOT_TAG):
+                break
+        return root, None
+
+
+def _write_header(load_streams, output, name):
+    '''Write the EntitiesDescriptor start tag, with the Name and the
+    Extensions of the first source, as well as its ID if it is the only
+    one. The Name defaults to name, as pyff names its selections.'''
+    root, extensions = _read_root(load_streams[0][0])
+    if root is None or root.tag != FEDERATION_ROOT_TAG:
+        root, extensions = etree.Element(FEDERATION_ROOT_TAG), None
+
+    attributes = dict((key, value) for key, value in root.attrib.items()
+                      if key in ('Name', 'validUntil', 'cacheDuration') or (key == 'ID' and len(load_streams) == 1))
+    if name and 'Name' not in attributes:
+        attributes['Name'] = name
+    header = etree.Element(FEDERATION_ROOT_TAG, attrib=attributes, nsmap=root.nsmap)
+    header.text = '\n'
+    if extensions is not None:
+        header.append(deepcopy(extensions))
+        header[-1].tail = '\n'
+
+    header = etree.tostring(header, encoding='UTF-8', xml_declaration=False)
+    output.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+    output.write(header[:header.rindex('</')])
+    return header[header.rindex('</'):]
+
+
+def _iter_source(filename, selector):
+    descriptor = SELECTORS.get(selector)
+    with open_metadata(filename) as source:
+        context = etree.iterparse(source, tag=ENTITY_ROOT_TAG, events=('end',), huge_tree=True,
+                                  remove_blank_text=True)
+        for _, element in context:
+            if descriptor is None or element.find(descriptor) is not None:
+                yield element
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        del context
+
+
+def select_entities(load_streams, output, name=None):
+    '''Write to output an EntitiesDescriptor with the EntityDescriptors of
+    every [filename, selector] of load_streams, keeping only the IDPs or
+    the SPs if the selector says so
+
+    Entities are copied one at a time, the sources are never loaded as a
+    whole. An entity found in several sources is written once. Return the
+    number of entities written.
+    '''
+    seen = set()
+    closing = _write_header(load_streams, output, name)
+    for filename, selector in load_streams:
+        for element in _iter_source(filename, selector):
+            entityid = element.get('entityID')
+            if entityid in seen:
+                continue
+            seen.add(entityid)
+            output.write(etree.tostring(element, encoding='UTF-8', xml_declaration=False, with_tail=False))
+            output.write('\n')
+    output.write(closing + '\n')
+    return len(seen)
@@ -11,12 +11,19 @@
 #########################################################################################
 
 import logging
+import resource
+import multiprocessing
 from datetime import date
+from contextlib import contextmanager
 
 from django.conf import settings
+from django.db import connection, connections
+from django.utils import timezone
 
-from met.metadataparser.utils import send_mail
-from met.metadataparser.models import Federation
+from met.metadataparser.utils import send_mail, federation_lock, FederationLocked
+from met.metadataparser.models import Federation, RefreshReport
+
+REFRESH_TIMEOUT = getattr(settings, "METADATA_REFRESH_TIMEOUT", 2 * 60 * 60)
 
 if settings.PROFILE:
     from silk.profiling.profiler import silk_profile as profile
@@ -32,58 +39,158 @@ def _send_message_via_email(error_msg, federation, logger=None):
     except Exception, errorMessage:
         log('Message could not be posted successfully: %s' % errorMessage, logger, logging.ERROR)
 
-def _fetch_new_metadata_file(federation, logger):
+def _fetch_new_metadata_file(federation, logger, report=None):
     try:
-        changed = federation.fetch_metadata_file(federation.slug)
+        changed = federation.fetch_metadata_file(report)
         return None, changed
     except Exception, errorMessage:
         log('%s' % errorMessage, logger, logging.ERROR)
         return "%s" % errorMessage, False
 
-def refresh(fed_name=None, force_refresh=False, logger=None):
+class _QueryCounter(list):
+    '''Stands for connection.queries to count the queries without keeping them'''
+    count = 0
+
+    def append(self, query):
+        self.count += 1
+
+@contextmanager
+def _count_queries(report):
+    queries, use_debug_cursor = connection.queries, connection.use_debug_cursor
+    counter = connection.queries = _QueryCounter()
+    connection.use_debug_cursor = True
+    try:
+        yield
+    finally:
+        connection.queries, connection.use_debug_cursor = queries, use_debug_cursor
+        report.queries = counter.count
+
+def _refresh_stages(federation, force_refresh, logger, report):
+    log('[%s] Refreshing metadata ...'  % federation, logger, logging.INFO)
+    error_msg, data_changed = _fetch_new_metadata_file(federation, logger, report)
+    report.error = error_msg
+
+    if not error_msg and (force_refresh or data_changed):
+        log('[%s] Updating database ...' % federation, logger, logging.INFO)
+     
+        log('[%s] Updating federation ...' % federation, logger, logging.DEBUG)
+        with report.stage('parse'):
+            federation.process_metadata()
+    
+        log('[%s] Updating federation entities ...' % federation, logger, logging.DEBUG)
+        with report.stage('entities'):
+            removed, updated = federation.process_metadata_entities(report=report)
+        log('[%s] Removed %s old entities and updated %s entities.' % (federation, removed, updated), logger, logging.INFO)
+    
+        log('[%s] Updating federation file and metadata_data...' % federation, logger, logging.DEBUG)
+        federation.metadata_update = date.today()
+        federation.save(update_fields=['file', 'metadata_update'])
+        log('[%s] Federation update time modified with %s' % (federation, federation.metadata_update), logger, logging.INFO)
+
+    log('[%s] Updating federation statistics ...' % federation, logger, logging.DEBUG)
+    with report.stage('stats'):
+        (computed, not_computed) = federation.compute_new_stats()
+    log('[%s] Computed statistics: %s' % (federation, computed), logger, logging.DEBUG)
+    log('[%s] NOT Computed statistics: %s' % (federation, not_computed), logger, logging.DEBUG)
+
+    return error_msg
+
+def _refresh_federation(federation, force_refresh, logger):
+    report = RefreshReport(federation=federation, started=timezone.now())
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with federation_lock(federation, blocking=False), _count_queries(report):
+            error_msg = _refresh_stages(federation, force_refresh, logger, report)
+
+    except FederationLocked, e:
+        log('[%s] %s, skipping it.' % (federation, e), logger, logging.WARNING)
+        return None
+
+    except Exception, e:
+        error_msg = '%s %s' % (report.error, e) if report.error else '%s' % e
+
+    report.total_time = (timezone.now() - report.started).total_seconds()
+    report.peak_rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    report.error = error_msg
+    try:
+        report.save()
+    except Exception, e:
+        log('[%s] Refresh report could not be saved: %s' % (federation, e), logger, logging.ERROR)
+
+    return error_msg
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+# Options of the refresh processes, inherited when they are forked
+_worker_options = None
+
+def _init_worker(options):
+    global _worker_options
+    _worker_options = options
+    # The connections inherited from the parent must not be shared
+    _close_connections()
+
+def _refresh_task(federation_id):
+    force_refresh, logger = _worker_options
+    try:
+        federation = Federation.objects.get(id=federation_id)
+        return federation_id, _refresh_federation(federation, force_refresh, logger)
+    except Exception, e:
+        return federation_id, '%s' % e
+
+def _refresh_parallel(federations, force_refresh, logger, workers):
+    _close_connections()
+    # A new process for every federation, so that its peak RSS is its own
+    pool = multiprocessing.Pool(min(workers, len(federations)), _init_worker, ((force_refresh, logger),),
+                                maxtasksperchild=1)
+    errors = {}
+    try:
+        results = [(federation, pool.apply_async(_refresh_task, (federation.id,))) for federation in federations]
+        pool.close()
+        # The results are waited for in the order the federations start, so
+        # each one has at least REFRESH_TIMEOUT seconds. The result of a
+        # killed process never comes and is timed out as well.
+        for federation, result in results:
+            try:
+                errors[federation.id] = result.get(REFRESH_TIMEOUT)[1]
+            except multiprocessing.TimeoutError:
+                errors[federation.id] = 'Refresh not finished after %d seconds or its process was killed' % REFRESH_TIMEOUT
+                log('[%s] %s' % (federation, errors[federation.id]), logger, logging.ERROR)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return [(federation, errors[federation.id]) for federation in federations]
+
+def refresh(fed_name=None, force_refresh=False, logger=None, workers=1):
     log('Starting refreshing metadata ...', logger, logging.INFO)
 
     federations = Federation.objects.all()
     federations.prefetch_related('etypes', 'federations', 'entity_categories')
+    federations = [federation for federation in federations if not fed_name or federation.slug == fed_name]
 
-    for federation in federations:
-        if fed_name and federation.slug != fed_name:
-            continue
+    if workers > 1 and connection.vendor == 'sqlite':
+        # sqlite allows a single writer and fails the concurrent ingests
+        log('Parallel refresh is not supported on sqlite, refreshing one federation at a time.', logger, logging.WARNING)
+        workers = 1
 
-        error_msg = None
-        try:
-            log('[%s] Refreshing metadata ...'  % federation, logger, logging.INFO)
-            error_msg, data_changed = _fetch_new_metadata_file(federation, logger)
-    
-            if not error_msg and (force_refresh or data_changed):
-                log('[%s] Updating database ...' % federation, logger, logging.INFO)
-             
-                log('[%s] Updating federation ...' % federation, logger, logging.DEBUG)
-                federation.process_metadata()
-            
-                log('[%s] Updating federation entities ...' % federation, logger, logging.DEBUG)
-                removed, updated = federation.process_metadata_entities()
-                log('[%s] Removed %s old entities and updated %s entities.' % (federation, removed, updated), logger, logging.INFO)
-            
-                log('[%s] Updating federation file and metadata_data...' % federation, logger, logging.DEBUG)
-                federation.metadata_update = date.today()
-                federation.save(update_fields=['file', 'metadata_update'])
-                log('[%s] Federation update time modified with %s' % (federation, federation.metadata_update), logger, logging.INFO)
-
-            log('[%s] Updating federation statistics ...' % federation, logger, logging.DEBUG)
-            (computed, not_computed) = federation.compute_new_stats()
-            log('[%s] Computed statistics: %s' % (federation, computed), logger, logging.DEBUG)
-            log('[%s] NOT Computed statistics: %s' % (federation, not_computed), logger, logging.DEBUG)
-
-        except Exception, e:
-            error_msg = '%s %s' % (error_msg, e)
-
-        finally:
-            if error_msg:
-                log('Sending following error via email: %s' % error_msg, logger, logging.INFO)
-                _send_message_via_email(error_msg, federation, logger)
-    
+    if workers > 1 and len(federations) > 1:
+        results = _refresh_parallel(federations, force_refresh, logger, workers)
+    else:
+        results = [(federation, _refresh_federation(federation, force_refresh, logger)) for federation in federations]
+
+    errors = [(federation, error_msg) for federation, error_msg in results if error_msg]
+    for federation, error_msg in errors:
+        log('Sending following error via email: %s' % error_msg, logger, logging.INFO)
+        _send_message_via_email(error_msg, federation, logger)
+
+    if errors:
+        log('Refreshing of %d federations failed: %s' % (len(errors), ', '.join(unicode(federation) for federation, _ in errors)),
+            logger, logging.ERROR)
     log('Refreshing metadata terminated.', logger, logging.INFO)
+    return errors
 
 def log(message, logger=None, severity=logging.INFO):
     if logger:
@@ -17,7 +17,819 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import gzip
+import hashlib
+import logging
+import mmap
+import shutil
+import tempfile
+import requests
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+from datetime import timedelta
+from unittest import skipIf
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from lxml import etree
+
+from met.metadataparser import compression
+from met.metadataparser.compression import compress_file, open_metadata
+from met.metadataparser import fetch
+from met.metadataparser.blobstore import blob_name, collect_garbage, is_blob, store_blob
+from met.metadataparser.fetch import fetch_source, fetch_sources
+from met.metadataparser.pipeline import can_select, select_entities
+from met.metadataparser.models import Federation, Entity, EntityCategory, EntityDigest, EntityStat, EntityType
+from met.metadataparser import models
+from met.metadataparser.models import (IngestCheckpoint, IngestJob, IngestProgress, MetadataDigest, MetadataSource,
+                                       ProgressReporter, ReferenceRegistry, RefreshReport, StagedEntity,
+                                       StagedRelation)
+from met.metadataparser import refresh_metadata
+from met.metadataparser.refresh_metadata import refresh, _refresh_parallel
+from met.metadataparser.utils import federation_lock, FederationLocked
+from met.metadataparser.entity_index import scan_entities, index_path, EntityIndex, MappedEntityIndex
+from met.metadataparser.xmlparser import MetadataParser, ENTITY_ROOT_TAG
+
+METADATA = """<?xml version="1.0" encoding="UTF-8"?>
+<!-- <md:EntityDescriptor entityID="https://commented.example.org/"></md:EntityDescriptor> -->
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui" Name="urn:test" ID="TEST-1">
+  <md:EntityDescriptor entityID="https://idp.example.org/idp?a=1&amp;b=2">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:Extensions>
+        <mdui:UIInfo>
+          <mdui:DisplayName xml:lang="en">Test IdP</mdui:DisplayName>
+          <mdui:Logo height="16" width="16" xml:lang="en">https://idp.example.org/logo.png</mdui:Logo>
+        </mdui:UIInfo>
+      </md:Extensions>
+    </md:IDPSSODescriptor>
+    <md:ContactPerson contactType="technical">
+      <md:GivenName>John</md:GivenName>
+      <md:EmailAddress>mailto:john@example.org</md:EmailAddress>
+    </md:ContactPerson>
+  </md:EntityDescriptor>
+  <EntityDescriptor xmlns="urn:oasis:names:tc:SAML:2.0:metadata" entityID='https://sp.example.org/shibboleth'>
+    <SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <AttributeConsumingService index="1">
+        <RequestedAttribute FriendlyName="mail" Name="urn:oid:0.9.2342.19200300.100.1.3" isRequired="true"/>
+      </AttributeConsumingService>
+    </SPSSODescriptor>
+  </EntityDescriptor>
+</md:EntitiesDescriptor>
+"""
+
+
+class MetadataParserTest(TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.xml')
+        with os.fdopen(fd, 'wb') as metadata_file:
+            metadata_file.write(METADATA)
+        self.parser = MetadataParser(filename=self.filename)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+        if os.path.exists(index_path(self.filename)):
+            os.unlink(index_path(self.filename))
+
+    def test_select_entities(self):
+        output = StringIO()
+        self.assertEqual(select_entities([[self.filename, 'IDP'], [self.filename, 'All']], output), 2)
+        entities = [(entity['entityid'], entity['entity_types'])
+                    for entity in MetadataParser(data=output.getvalue()).iter_entities(details=False)]
+        self.assertEqual(entities, [('https://idp.example.org/idp?a=1&b=2', ['IDPSSODescriptor']),
+                                    ('https://sp.example.org/shibboleth', ['SPSSODescriptor'])])
+
+        output = StringIO()
+        self.assertEqual(select_entities([[self.filename, 'SP']], output), 1)
+        self.assertTrue(can_select([[self.filename, 'SP']]))
+        self.assertFalse(can_select([[self.filename, 'SP'], ['http://example.org/metadata.xml', 'All']]))
+
+    def test_select_entities_root(self):
+        with open(self.filename, 'wb') as metadata_file:
+            metadata_file.write(METADATA.replace('ID="TEST-1">', 'ID="TEST-1">\n<md:Extensions><mdrpi:PublicationInfo '
+                                                 'xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi" '
+                                                 'publisher="urn:test"/></md:Extensions>'))
+        output = StringIO()
+        select_entities([[self.filename, 'IDP']], output, 'test')
+        metadata = MetadataParser(data=output.getvalue())
+        self.assertEqual((metadata.file_id, metadata.get_federation()['Name']), ('TEST-1', 'urn:test'))
+        self.assertEqual(metadata.rootelem.find('{urn:oasis:names:tc:SAML:2.0:metadata}Extensions')[0].get('publisher'),
+                         'urn:test')
+        self.assertEqual([entity['entityid'] for entity in metadata.iter_entities(details=False)],
+                         ['https://idp.example.org/idp?a=1&b=2'])
+
+        # Without Name and ID in the source, they are set as pyff sets them
+        with open(self.filename, 'wb') as metadata_file:
+            metadata_file.write(METADATA.replace(' Name="urn:test" ID="TEST-1"', ''))
+        output = StringIO()
+        select_entities([[self.filename, 'All']], output, 'test')
+        metadata = MetadataParser(data=output.getvalue())
+        native = (metadata.file_id, metadata.get_federation()['Name'])
+        self.assertEqual(native, (None, 'test'))
+
+        output = StringIO()
+        try:
+            Federation(slug='test')._pyff_select([[self.filename, 'All']], output)
+        except Exception, e:
+            self.skipTest('pyff can not be loaded: %s' % e)
+        metadata = MetadataParser(data=output.getvalue())
+        self.assertEqual((metadata.file_id, metadata.get_federation()['Name']), native)
+
+    def test_scan_entities(self):
+        with open(self.filename, 'rb') as stream:
+            encoding, namespaces, entities = scan_entities(stream)
+
+        self.assertEqual(encoding, 'UTF-8')
+        self.assertEqual(namespaces.keys(), ['md', 'mdui'])
+        self.assertEqual([entityid for entityid, _, _ in entities],
+                         [u'https://idp.example.org/idp?a=1&b=2', u'https://sp.example.org/shibboleth'])
+        for _, offset, length in entities:
+            fragment = METADATA[offset:offset + length]
+            self.assertTrue(fragment.startswith('<'))
+            self.assertTrue(fragment.endswith('EntityDescriptor>'))
+
+    def test_scan_entities_small_chunks(self):
+        with open(self.filename, 'rb') as stream:
+            expected = scan_entities(stream)
+        with open(self.filename, 'rb') as stream:
+            self.assertEqual(scan_entities(stream, chunk_size=7), expected)
+
+    def test_get_entity_uses_index(self):
+        self.assertEqual(list(self.parser.index), self.parser.get_entities())
+        self.assertTrue(self.parser.entity_exist('https://sp.example.org/shibboleth'))
+        self.assertFalse(self.parser.entity_exist('https://commented.example.org/'))
+
+        entity = self.parser.get_entity('https://idp.example.org/idp?a=1&b=2')
+        self.assertEqual(entity['displayName'], {'en': 'Test IdP'})
+        self.assertEqual(entity['entity_types'], ['IDPSSODescriptor'])
+        self.assertEqual(entity['contacts'][0]['email'], 'mailto:john@example.org')
+
+        entity = self.parser.get_entity('https://sp.example.org/shibboleth')
+        self.assertEqual(entity['attr_requested']['required'],
+                         [['urn:oid:0.9.2342.19200300.100.1.3', 'mail']])
+
+    def test_sidecar_index(self):
+        built = EntityIndex.build(self.filename)
+        self.parser.prepare_index()
+        self.assertTrue(os.path.exists(index_path(self.filename)))
+
+        mapped = MappedEntityIndex.open(self.filename)
+        self.assertEqual(list(mapped), list(built))
+        self.assertEqual(mapped.content_digest, built.content_digest)
+        self.assertEqual(mapped.namespaces, built.namespaces)
+        for entityid in built:
+            self.assertEqual(mapped.get(entityid), built.get(entityid))
+        self.assertEqual(mapped.get('https://commented.example.org/'), None)
+        mapped.close()
+
+    def test_stale_sidecar_index(self):
+        self.parser.prepare_index()
+        with open(self.filename, 'ab') as metadata_file:
+            metadata_file.write('\n')
+        self.assertEqual(MappedEntityIndex.open(self.filename), None)
+
+    def test_rewritten_sidecar_index(self):
+        os.utime(self.filename, (1000000000, 1000000000))
+        self.parser.prepare_index()
+        # Same size and mtime, other content
+        rewritten = METADATA.replace('idp.example.org', 'idp.example.net')
+        with open(self.filename, 'wb') as metadata_file:
+            metadata_file.write(rewritten)
+        os.utime(self.filename, (1000000000, 1000000000))
+
+        digest = hashlib.sha256(rewritten).hexdigest()
+        self.assertEqual(MappedEntityIndex.open(self.filename, digest), None)
+        parser = MetadataParser(filename=self.filename, content_digest=digest)
+        self.assertEqual(parser.get_entities(), list(parser.index))
+        self.assertTrue(parser.entity_exist('https://idp.example.net/idp?a=1&b=2'))
+
+    def test_get_entity_not_found(self):
+        self.assertRaises(ValueError, self.parser.get_entity, 'https://commented.example.org/')
+
+    def test_iter_entities(self):
+        entities = list(self.parser.iter_entities())
+        self.assertEqual([entity['entityid'] for entity in entities], self.parser.get_entities())
+        for entity in entities:
+            lazy_entity = self.parser.get_entity(entity['entityid']).copy()
+            del lazy_entity['xml']
+            self.assertEqual(entity, lazy_entity)
+
+        for entity in self.parser.iter_entities(details=False):
+            self.assertEqual(entity, self.parser.get_entity(entity['entityid'], False))
+
+    def test_lazy_entity(self):
+        entity = self.parser.get_entity('https://idp.example.org/idp?a=1&b=2')
+        self.assertEqual(entity['displayName'], {'en': 'Test IdP'})
+        self.assertFalse('xml' in entity._fields)
+        self.assertEqual(entity.get('scopes'), None)
+
+        self.assertTrue(entity['xml'].startswith('<md:EntityDescriptor'))
+        self.assertTrue('xml' in entity._fields)
+
+    def test_get_entity_xml(self):
+        xml = self.parser.get_entity_xml('https://idp.example.org/idp?a=1&b=2')
+        self.assertTrue(xml.startswith('<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+                                       'xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui" entityID='))
+        self.assertTrue(xml.endswith('</md:EntityDescriptor>'))
+        self.assertEqual(etree.fromstring(xml).get('entityID'), 'https://idp.example.org/idp?a=1&b=2')
+
+        # The default namespace is already declared on the entity
+        xml = self.parser.get_entity_xml('https://sp.example.org/shibboleth', pretty=True)
+        self.assertEqual(xml.count('xmlns="urn:oasis:names:tc:SAML:2.0:metadata"'), 1)
+        self.assertTrue('\n  <SPSSODescriptor' in xml)
+
+    def test_iter_entities_parallel(self):
+        parser = MetadataParser(filename=self.filename, workers=2, parallel_min_size=0)
+        for details in (True, False):
+            self.assertEqual(list(parser.iter_entities(details)), list(self.parser.iter_entities(details)))
+
+    def test_compressed_metadata(self):
+        # A single gzip member, without the blocks table of the stored files
+        fd, filename = tempfile.mkstemp(suffix='.xml.gz')
+        os.close(fd)
+        with gzip.open(filename, 'wb') as metadata_file:
+            metadata_file.write(METADATA)
+
+        try:
+            parser = MetadataParser(filename=filename)
+            self.assertEqual(parser.get_entities(), self.parser.get_entities())
+            self.assertEqual(list(parser.iter_entities()), list(self.parser.iter_entities()))
+            for entityid in self.parser.get_entities():
+                self.assertEqual(parser.get_entity(entityid), self.parser.get_entity(entityid))
+        finally:
+            os.unlink(filename)
+            if os.path.exists(index_path(filename)):
+                os.unlink(index_path(filename))
+
+    def test_blocked_gzip_metadata(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'metadata.xml.gz')
+        block_size = compression.BLOCK_SIZE
+        compression.BLOCK_SIZE = 100
+        try:
+            compress_file(StringIO(METADATA), filename, 'gzip')
+            stream = open_metadata(filename)
+            self.assertTrue(isinstance(stream, compression.BlockedGzipFile))
+            self.assertEqual(stream.read(), METADATA)
+            for offset in (len(METADATA) - 10, 250, 0, 99, 100):
+                stream.seek(offset)
+                self.assertEqual(stream.read(150), METADATA[offset:offset + 150])
+            stream.close()
+
+            parser = MetadataParser(filename=filename)
+            for entityid in self.parser.get_entities():
+                self.assertEqual(parser.get_entity(entityid), self.parser.get_entity(entityid))
+        finally:
+            compression.BLOCK_SIZE = block_size
+            shutil.rmtree(directory)
+
+    def test_metadata_from_data(self):
+        expected = list(self.parser.iter_entities())
+        with open(self.filename, 'rb') as metadata_file:
+            source = mmap.mmap(metadata_file.fileno(), 0, access=mmap.ACCESS_READ)
+            metadata_file.seek(0)
+            for data in (METADATA, metadata_file, source):
+                parser = MetadataParser(data=data)
+                self.assertEqual(parser.file_id, 'TEST-1')
+                self.assertEqual(list(parser.iter_entities()), expected)
+                self.assertEqual(parser.get_entity_xml('https://sp.example.org/shibboleth'),
+                                 self.parser.get_entity_xml('https://sp.example.org/shibboleth'))
+            source.close()
+
+    def test_walk_entity(self):
+        context = etree.iterparse(self.filename, tag=ENTITY_ROOT_TAG, events=('end',))
+        for _, element in context:
+            for details in (True, False):
+                self.assertEqual(MetadataParser._walk_entity(element, details),
+                                 MetadataParser._get_entity_by_xpath(element, details))
+
+
+class FederationTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.federation = Federation(name='Test federation')
+        self.federation.file.save('test-metadata.xml', ContentFile(METADATA), save=False)
+        self.federation.save()
+        self.federation.process_metadata()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_process_metadata_entities(self):
+        removed, updated = self.federation.process_metadata_entities()
+        self.assertEqual((removed, updated), (0, 2))
+
+        entities = Entity.objects.filter(federations=self.federation).order_by('entityid')
+        self.assertEqual([entity.entityid for entity in entities],
+                         [u'https://idp.example.org/idp?a=1&b=2', u'https://sp.example.org/shibboleth'])
+        self.assertEqual([t.xmlname for t in entities[0].types.all()], ['IDPSSODescriptor'])
+        self.assertEqual(entities[0].name, {'en': 'Test IdP'})
+
+        removed, updated = self.federation.process_metadata_entities()
+        self.assertEqual((removed, updated), (0, 0))
+
+    def test_skip_unchanged_entities(self):
+        self.federation.process_metadata_entities()
+        self.assertEqual(EntityDigest.objects.filter(federation=self.federation).count(), 2)
+
+        idp = 'https://idp.example.org/idp?a=1&b=2'
+        Entity.objects.filter(entityid=idp).update(name={'en': 'Renamed'})
+        self.assertEqual(self.federation.process_metadata_entities(), (0, 0))
+        self.assertEqual(Entity.objects.get(entityid=idp).name, {'en': 'Renamed'})
+
+        # A different digest means the EntityDescriptor changed
+        EntityDigest.objects.filter(entity__entityid=idp).update(digest='0' * 40)
+        self.assertEqual(self.federation.process_metadata_entities(), (0, 1))
+        self.assertEqual(Entity.objects.get(entityid=idp).name, {'en': 'Test IdP'})
+
+    def test_failed_ingest_rolls_back(self):
+        self.federation.process_metadata_entities()
+        sp = Entity.objects.get(entityid='https://sp.example.org/shibboleth')
+        Entity.objects.filter(entityid='https://idp.example.org/idp?a=1&b=2').delete()
+        publish = self.federation._publish_staged
+
+        def fail():
+            publish()
+            raise ValueError('Ingest failed')
+        self.federation._publish_staged = fail
+
+        with self.assertRaises(ValueError):
+            self.federation.process_metadata_entities()
+        self.assertEqual(list(self.federation.entity_set.all()), [sp])
+        self.assertEqual(EntityDigest.objects.filter(federation=self.federation).count(), 1)
+
+        # The next run publishes the entity created by the failed one
+        del self.federation._publish_staged
+        self.assertEqual(self.federation.process_metadata_entities(), (0, 1))
+        self.assertEqual(self.federation.entity_set.count(), 2)
+
+    def test_publish_staged_entities(self):
+        with CaptureQueriesContext(connection) as context:
+            self.federation.process_metadata_entities()
+        queries = [query['sql'] for query in context.captured_queries]
+
+        # The publish transaction only copies the staged rows over
+        publish = [pos for pos, sql in enumerate(queries) if 'INSERT INTO "metadataparser_entitydigest"' in sql][0]
+        start = [pos for pos, sql in enumerate(queries[:publish]) if "'SAVEPOINT" in sql][-1]
+        end = [pos for pos, sql in enumerate(queries) if pos > publish and "'RELEASE SAVEPOINT" in sql][0]
+        for sql in queries[start + 1:end]:
+            if 'metadataparser_ingestcheckpoint' not in sql:
+                self.assertIn('"metadataparser_staged', sql)
+        self.assertFalse(StagedEntity.objects.exists())
+        self.assertFalse(StagedRelation.objects.exists())
+
+    def test_resume_interrupted_ingest(self):
+        checkpoint_size = models.INGEST_CHECKPOINT_SIZE
+        publish = self.federation._publish_staged
+        calls = []
+
+        def publish_once():
+            if calls:
+                raise ValueError('Killed')
+            calls.append(True)
+            return publish()
+
+        models.INGEST_CHECKPOINT_SIZE = 1
+        self.federation._publish_staged = publish_once
+        try:
+            with self.assertRaises(ValueError):
+                self.federation.process_metadata_entities()
+        finally:
+            models.INGEST_CHECKPOINT_SIZE = checkpoint_size
+            del self.federation._publish_staged
+
+        # The first batch was committed with its checkpoint
+        self.assertEqual(self.federation.entity_set.count(), 1)
+        self.assertEqual(IngestCheckpoint.objects.get(federation=self.federation).batch, 1)
+
+        self.assertEqual(self.federation.process_metadata_entities(), (0, 1))
+        self.assertEqual(self.federation.entity_set.count(), 2)
+        self.assertFalse(IngestCheckpoint.objects.exists())
+
+    def test_ingest_checkpoint(self):
+        digests = {'https://a.example.org/': '1', 'https://b.example.org/': '2', 'https://c.example.org/': '3'}
+        checkpoint = IngestCheckpoint.resume(self.federation, digests)
+        self.assertEqual(checkpoint.batches(set(digests), 2), [['https://a.example.org/', 'https://b.example.org/'],
+                                                               ['https://c.example.org/']])
+        checkpoint.commit()
+
+        checkpoint = IngestCheckpoint.resume(self.federation, digests)
+        self.assertEqual(checkpoint.batches(set(digests), 2), [['https://c.example.org/']])
+
+        # Another metadata file starts over
+        digests['https://c.example.org/'] = '4'
+        checkpoint = IngestCheckpoint.resume(self.federation, digests)
+        self.assertEqual(checkpoint.batch, 0)
+
+    def test_sync_relations(self):
+        self.federation.process_metadata_entities()
+        idp = Entity.objects.get(entityid='https://idp.example.org/idp?a=1&b=2')
+        self.assertEqual([t.xmlname for t in idp.types.all()], ['IDPSSODescriptor'])
+
+        # Relations missing from the metadata are removed
+        idp.types.add(EntityType.objects.create(xmlname='Other', name='Other'))
+        EntityDigest.objects.filter(entity=idp).update(digest='0' * 40)
+        self.federation.process_metadata_entities()
+        self.assertEqual([t.xmlname for t in idp.types.all()], ['IDPSSODescriptor'])
+
+    def test_reference_registry(self):
+        registry = ReferenceRegistry()
+        registry.ensure(['IDPSSODescriptor', 'SPSSODescriptor'], ['http://refeds.org/category/hide-from-discovery'])
+        self.assertEqual(EntityType.objects.filter(xmlname__in=['IDPSSODescriptor', 'SPSSODescriptor']).count(), 2)
+        self.assertEqual(registry.entity_categories['http://refeds.org/category/hide-from-discovery'],
+                         EntityCategory.objects.get(category_id='http://refeds.org/category/hide-from-discovery'))
+
+        with self.assertNumQueries(0):
+            registry.ensure(['IDPSSODescriptor'], ['http://refeds.org/category/hide-from-discovery'])
+
+        # Created meanwhile by another ingest
+        registry = ReferenceRegistry()
+        EntityCategory.objects.create(category_id='http://refeds.org/category/research-and-scholarship')
+        registry.entity_categories.clear()
+        registry.ensure([], ['http://refeds.org/category/hide-from-discovery',
+                             'http://refeds.org/category/research-and-scholarship'])
+        self.assertEqual(EntityCategory.objects.count(), 2)
+        self.assertEqual(len(registry.entity_categories), 2)
+
+    def test_compute_new_stats(self):
+        self.federation.process_metadata_entities()
+        EntityStat.objects.create(federation=self.federation, feature='sp', value=0,
+                                  time=timezone.now() - timedelta(days=1))
+        computed, _ = self.federation.compute_new_stats()
+        self.assertEqual(computed['idp'], 1)
+        self.assertEqual(computed['sp'], 1)
+        self.assertTrue(EntityStat.objects.filter(federation=self.federation).exists())
+
+    def test_remove_entities(self):
+        self.federation.process_metadata_entities()
+        idp = Entity.objects.get(entityid='https://idp.example.org/idp?a=1&b=2')
+        sp = Entity.objects.get(entityid='https://sp.example.org/shibboleth')
+        other = Federation.objects.create(name='Other federation')
+        sp.federations.add(other)
+
+        self.assertEqual(self.federation._stage_deleted_entities({sp.entityid: ''}), [idp.id])
+        self.federation._publish_staged()
+        self.assertEqual(list(self.federation.entity_set.all()), [sp])
+        self.assertEqual(Entity.get_orphans([idp.id, sp.id]), [idp])
+        self.assertFalse(EntityDigest.objects.filter(entity=idp).exists())
+
+        orphans = other.remove_entities([sp.id], delete_orphans=True)
+        self.assertEqual(orphans, [])
+        self.assertEqual(list(sp.federations.all()), [self.federation])
+
+        self.federation.remove_entities([sp.id], delete_orphans=True)
+        self.assertFalse(Entity.objects.filter(id=sp.id).exists())
+
+    def test_refresh_federation_lock(self):
+        logger = logging.getLogger('met.tests')
+        # Only the statistics of today are computed then
+        EntityStat.objects.create(federation=self.federation, feature='sp', value=0, time=timezone.now())
+        with federation_lock(self.federation):
+            with self.assertRaises(FederationLocked):
+                with federation_lock(self.federation, blocking=False):
+                    pass
+            self.assertEqual(refresh(self.federation.slug, True, logger), [])
+            self.assertFalse(self.federation.entity_set.exists())
+
+        self.assertEqual(refresh(self.federation.slug, True, logger), [])
+        self.assertEqual(self.federation.entity_set.count(), 2)
+
+        # The refresh skipped while the federation was locked has no report
+        report = RefreshReport.objects.get(federation=self.federation)
+        self.assertEqual((report.entities_added, report.entities_updated, report.entities_removed), (2, 0, 0))
+        self.assertTrue(report.queries > 0 and report.peak_rss_growth >= 0)
+        self.assertTrue(report.total_time >= report.entities_time > 0)
+        self.assertEqual(report.error, None)
+
+        output = StringIO()
+        call_command('met_refresh_report', federation=self.federation.slug, stdout=output)
+        self.assertIn('[Test federation]', output.getvalue())
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_progress_reporter(self):
+        progress = ProgressReporter(self.federation, use_cache=False)
+        progress.start(250)
+        with self.assertNumQueries(0):
+            progress.update(1)
+        self.assertEqual(ProgressReporter.read(self.federation, use_cache=False), {'tot': 250, 'num': 0, 'done': False})
+
+        progress.update(101)
+        progress.finish()
+        self.assertEqual(ProgressReporter.read(self.federation, use_cache=False), {'tot': 250, 'num': 101, 'done': True})
+
+        progress = ProgressReporter(self.federation, use_cache=True)
+        progress.start(2)
+        progress.update(2)
+        self.assertEqual(ProgressReporter.read(self.federation, use_cache=True), {'tot': 2, 'num': 2, 'done': False})
+        self.assertEqual(IngestProgress.objects.get(federation=self.federation).current, 101)
+
+    def test_ingest_job(self):
+        job = IngestJob.enqueue(self.federation, 'update_entities')
+        self.assertEqual(IngestJob.enqueue(self.federation, 'update_entities'), job)
+        self.assertEqual(IngestJob.enqueue(self.federation, 'process_metadata').kind, 'process_metadata')
+
+        call_command('met_worker', once=True, stdout=StringIO())
+        self.assertFalse(IngestJob.objects.exclude(status='done').exists())
+
+        job = IngestJob.objects.get(id=job.id)
+        self.assertEqual((job.progress_current, job.progress_total), (2, 2))
+        self.assertEqual(job.result, 'Removed 0 old entities and updated 2 entities.')
+        self.assertTrue(job.to_dict()['duration'] >= 0)
+        self.assertEqual(Entity.objects.filter(federations=self.federation).count(), 2)
+
+    def test_failed_ingest_job(self):
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        def fail(*args, **kwargs):
+            raise ValueError('Ingest failed')
+
+        records = []
+        handler = Handler()
+        logging.getLogger('met.metadataparser.models').addHandler(handler)
+        try:
+            job = IngestJob.enqueue(self.federation, 'update_entities')
+            job.federation.process_metadata_entities = fail
+            job.run()
+        finally:
+            logging.getLogger('met.metadataparser.models').removeHandler(handler)
+
+        self.assertEqual((job.status, job.error), ('failed', 'Ingest failed'))
+        self.assertEqual(records[0].exc_info[0], ValueError)
+
+    def test_stale_ingest_job(self):
+        job = IngestJob.enqueue(self.federation, 'update_entities')
+        self.assertEqual(IngestJob.claim(), job)
+        self.assertEqual(IngestJob.enqueue(self.federation, 'update_entities'), job)
+
+        # The worker running the job was killed and stopped sending its heartbeat
+        IngestJob.objects.filter(id=job.id).update(heartbeat=timezone.now() - timedelta(hours=1))
+        self.assertEqual(IngestJob.enqueue(self.federation, 'update_entities'), job)
+        self.assertEqual(IngestJob.objects.get(id=job.id).status, 'pending')
+        self.assertEqual(IngestJob.claim(), job)
+
+
+class MetadataRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ETAG = '"v1"'
+    LAST_MODIFIED = 'Sat, 17 Oct 2026 10:00:00 GMT'
+
+    def do_GET(self):
+        self.server.conditions.append(self.headers.get('If-None-Match'))
+        if self.path.startswith('/flaky') and self.path not in self.server.failed:
+            # Fail the first request of every flaky source
+            self.server.failed.add(self.path)
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', self.ETAG)
+        self.send_header('Last-Modified', self.LAST_MODIFIED)
+        self.send_header('Content-Length', str(len(METADATA)))
+        self.end_headers()
+        self.wfile.write(METADATA)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetadataServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _killed_refresh_task(federation_id):
+    os._exit(1)
+
+
+class ParallelRefreshTest(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.federation = Federation(name='Test federation')
+        self.federation.file.save('test-metadata.xml', ContentFile(METADATA), save=False)
+        self.federation.save()
+        EntityStat.objects.create(federation=self.federation, feature='sp', value=0, time=timezone.now())
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    @skipIf(connection.vendor == 'sqlite' and connection.settings_dict['TEST']['NAME'] is None,
+            'the refresh processes can not share an in-memory database')
+    def test_refresh_parallel(self):
+        # The file is big enough for the parser to use its own pool of processes
+        workers, min_size = models.PARSER_WORKERS, models.PARSER_PARALLEL_MIN_SIZE
+        models.PARSER_WORKERS, models.PARSER_PARALLEL_MIN_SIZE = 2, 0
+        try:
+            results = _refresh_parallel([self.federation], True, logging.getLogger('met.tests'), 2)
+        finally:
+            models.PARSER_WORKERS, models.PARSER_PARALLEL_MIN_SIZE = workers, min_size
+
+        self.assertEqual(results, [(self.federation, None)])
+        self.assertEqual(self.federation.entity_set.count(), 2)
+
+    def test_refresh_killed(self):
+        refresh_task, timeout = refresh_metadata._refresh_task, refresh_metadata.REFRESH_TIMEOUT
+        refresh_metadata._refresh_task, refresh_metadata.REFRESH_TIMEOUT = _killed_refresh_task, 1
+        try:
+            results = _refresh_parallel([self.federation], True, logging.getLogger('met.tests'), 2)
+        finally:
+            refresh_metadata._refresh_task, refresh_metadata.REFRESH_TIMEOUT = refresh_task, timeout
+
+        self.assertEqual(results, [(self.federation, 'Refresh not finished after 1 seconds or its process was killed')])
+
+
+class FetchTest(TestCase):
+    def setUp(self):
+        self.server = MetadataServer(('127.0.0.1', 0), MetadataRequestHandler)
+        self.server.conditions = []
+        self.server.failed = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/metadata.xml' % self.server.server_port
+
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.federation = Federation(name='Test federation')
+        self.federation.file.save('test-metadata.xml', ContentFile(METADATA), save=False)
+        self.federation.save()
+        self.federation.file_url = self.url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_fetch_source(self):
+        filename = os.path.join(self.media_root, 'source.xml')
+        self.assertEqual(fetch_source(self.url, filename),
+                         (len(METADATA), MetadataRequestHandler.ETAG, MetadataRequestHandler.LAST_MODIFIED))
+        with open(filename) as source:
+            self.assertEqual(source.read(), METADATA)
+        self.assertEqual(fetch_source(self.url, filename, '"v1"', MetadataRequestHandler.LAST_MODIFIED),
+                         (None, '"v1"', MetadataRequestHandler.LAST_MODIFIED))
+        self.assertEqual(self.server.conditions, [None, '"v1"'])
+
+    def test_fetch_sources(self):
+        base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        sources = [(base_url + name, os.path.join(self.media_root, name), None, None)
+                   for name in ('a.xml', 'b.xml', 'flaky.xml')]
+        retry_delay = fetch.RETRY_DELAY
+        fetch.RETRY_DELAY = 0
+        try:
+            results = fetch_sources(sources)
+        finally:
+            fetch.RETRY_DELAY = retry_delay
+
+        self.assertEqual([size for size, _, _ in results], [len(METADATA)] * 3)
+        for _, filename, _, _ in sources:
+            with open(filename) as source:
+                self.assertEqual(source.read(), METADATA)
+        self.assertEqual(len(self.server.conditions), 4)
+
+        self.assertRaises(requests.HTTPError, fetch_source, base_url + 'flaky-again.xml',
+                          os.path.join(self.media_root, 'flaky.xml'), retries=0)
+
+    def test_fetch_metadata_file(self):
+        self.federation.file_url = '%s;SP' % self.url
+        self.assertEqual(self.federation.fetch_metadata_file(), True)
+        entities = [entity['entityid'] for entity in self.federation.load_file().iter_entities(details=False)]
+        self.assertEqual(entities, ['https://sp.example.org/shibboleth'])
+
+        # Nothing about the new file is stored before the federation is
+        self.assertFalse(MetadataSource.objects.exists())
+        self.federation.save(update_fields=['file'])
+        with open(self.federation.file.path) as metadata_file:
+            self.assertEqual(MetadataDigest.objects.get().sha256, hashlib.sha256(metadata_file.read()).hexdigest())
+
+        # The source answers 304 and nothing is downloaded again
+        self.assertEqual(self.federation.fetch_metadata_file(), False)
+        self.assertEqual(self.server.conditions, [None, '"v1"'])
+
+    def test_unsaved_fetch(self):
+        self.federation.file_url = '%s;SP' % self.url
+        self.assertEqual(self.federation.fetch_metadata_file(), True)
+
+        # The federation was not saved, as after a failed refresh
+        federation = Federation.objects.get(pk=self.federation.pk)
+        federation.file_url = self.federation.file_url
+        self.assertEqual(federation.fetch_metadata_file(), True)
+        self.assertEqual(self.server.conditions, [None, None])
+
+    def test_changed_selectors(self):
+        self.federation.file_url = '%s;IDP' % self.url
+        self.federation._save_sources({self.url: ('"v1"', MetadataRequestHandler.LAST_MODIFIED)})
+
+        self.federation.file_url = '%s;SP' % self.url
+        self.assertEqual(self.federation.fetch_metadata_file(), True)
+        self.assertEqual(self.server.conditions, [None])
+
+    def test_deferred_fetch(self):
+        # As saved by the edit view, the download is left to the job
+        self.federation.file_url = '%s;SP' % self.url
+        self.federation.defer_fetch = True
+        self.federation.save()
+        self.assertEqual(self.server.conditions, [])
+
+        IngestJob.enqueue(self.federation, 'process_metadata')
+        job = IngestJob.claim()
+        job.run()
+        self.assertEqual((job.status, job.error), ('done', None))
+        self.assertEqual(self.server.conditions, [None])
+        self.assertEqual([entity.entityid for entity in self.federation.entity_set.all()],
+                         ['https://sp.example.org/shibboleth'])
+        self.assertEqual(MetadataSource.objects.get().file_url, self.federation.file_url)
+
+    def test_shared_blobs(self):
+        old_path = self.federation.file.path
+        other = Federation(name='Other federation', file_url=self.url)
+        self.assertEqual(self.federation.fetch_metadata_file(), True)
+        # The replaced file is kept until the new one is saved
+        self.assertTrue(os.path.exists(old_path))
+        self.federation.save()
+        self.assertEqual(other.fetch_metadata_file(), True)
+        other.save()
+
+        self.assertEqual(self.federation.file.name, other.file.name)
+        self.assertTrue(is_blob(self.federation.file.name))
+        self.assertFalse(os.path.exists(old_path))
+
+        unused = os.path.join(self.media_root, 'unused.xml')
+        with open(unused, 'wb') as unused_file:
+            unused_file.write('<unused/>')
+        unused_name = blob_name(hashlib.sha256('<unused/>').hexdigest())
+        store_blob(unused_name, unused)
+
+        self.assertEqual(collect_garbage([self.federation.file.name]), [])
+        out = StringIO()
+        call_command('met_gc_blobs', min_age=0, stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [unused_name, '1 blobs deleted'])
+        self.assertTrue(os.path.exists(self.federation.file.path))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, unused_name)))
+
+    def test_compressed_blob(self):
+        models.METADATA_COMPRESSION = 'gzip'
+        try:
+            self.assertEqual(self.federation.fetch_metadata_file(), True)
+        finally:
+            models.METADATA_COMPRESSION = None
+        self.assertTrue(os.path.exists(compression.blocks_path(self.federation.file.path)))
+        with open_metadata(self.federation.file.path) as stream:
+            self.assertTrue(isinstance(stream, compression.BlockedGzipFile))
+
+        collect_garbage([], min_age=0)
+        self.assertFalse(os.path.exists(compression.blocks_path(self.federation.file.path)))
+
+    def test_file_digest(self):
+        self.assertEqual(self.federation._get_file_digest(), hashlib.sha256(METADATA).hexdigest())
+        self.federation._set_file_digest('0' * 64)
+        self.assertEqual(self.federation._get_file_digest(), '0' * 64)
+
+        # A digest stored for a previous file is not used
+        MetadataDigest.objects.update(file_name='other-metadata.xml')
+        self.assertEqual(self.federation._get_file_digest(), hashlib.sha256(METADATA).hexdigest())
+
+    def test_not_modified_sources(self):
+        self.federation._save_sources({self.url: ('"v1"', MetadataRequestHandler.LAST_MODIFIED)})
+        self.assertEqual(self.federation.fetch_metadata_file(), False)
+        self.assertEqual(self.server.conditions, ['"v1"'])
+
+    def test_download_changed_sources(self):
+        self.federation._save_sources({self.url: ('"v0"', None)})
+        directory = tempfile.mkdtemp()
+        try:
+            load_streams, validators, size = self.federation._download_sources([[self.url, 'IDP']], directory)
+            self.assertEqual(load_streams, [[os.path.join(directory, 'source0.xml'), 'IDP']])
+            self.assertEqual(size, len(METADATA))
+            with open(load_streams[0][0]) as source:
+                self.assertEqual(source.read(), METADATA)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(validators, {self.url: ('"v1"', MetadataRequestHandler.LAST_MODIFIED)})
+        self.federation._save_sources(validators)
+        self.assertEqual(MetadataSource.objects.get(url=self.url).etag, '"v1"')
 
 
 class SimpleTest(TestCase):
@@ -20,6 +20,7 @@ urlpatterns = patterns('met.metadataparser.views',
         'entityupdate_progress', name='entityupdate_progress'),
     url(r'^federation/(?P<federation_slug>[-\w]+)/federation_update_entities/$',
         'federation_update_entities', name='federation_update_entities'),
+    url(r'^job/(?P<job_id>\d+)/$', 'job_status', name='job_status'),
     url(r'^federation/(?P<federation_slug>[-\w]+)/edit/$', 'federation_edit',
         name='federation_edit'),
     url(r'^federation/(?P<federation_slug>[-\w]+)/delete/$', 'federation_delete',
@@ -10,19 +10,32 @@
 # Consortium GARR, http://www.garr.it
 #########################################################################################
 
-import hashlib, smtplib
+import os, fcntl, tempfile
+import smtplib
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from django.conf import settings
 
-def compare_filecontents(a, b):
-    if a is None:
-        return b is None
-    if b is None:
-        return a is None
+class FederationLocked(Exception):
+    pass
 
-    md5_a = hashlib.md5(a).hexdigest()
-    md5_b = hashlib.md5(b).hexdigest()
-    return md5_a == md5_b
+@contextmanager
+def federation_lock(federation, blocking=True):
+    '''Hold the lock that keeps two processes from ingesting the same
+    federation at once; raise FederationLocked if blocking is False and
+    another process holds it'''
+    lock_dir = getattr(settings, 'FEDERATION_LOCK_DIR', None) or tempfile.gettempdir()
+    lock_file = open(os.path.join(lock_dir, 'met-federation-%s.lock' % federation.id), 'a')
+    try:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except IOError:
+            raise FederationLocked('Federation %s is being updated by another process' % federation)
+        yield
+    finally:
+        # Closing the file releases the lock
+        lock_file.close()
 
 def _connect_to_smtp(server, port=25, login_type=None, username=None, password=None):
     smtp_send = smtplib.SMTP(server, port)
@@ -33,14 +33,15 @@ from django.utils import timezone
 from chartit import DataPool, Chart
 
 from met.metadataparser.decorators import user_can_edit
-from met.metadataparser.models import Federation, Entity, EntityStat, EntityCategory, TOP_LENGTH, FEDERATION_TYPES
+from met.metadataparser.models import (Federation, Entity, EntityStat, EntityCategory, IngestJob, ProgressReporter,
+                                       TOP_LENGTH, FEDERATION_TYPES)
 from met.metadataparser.forms import (FederationForm, EntityForm, EntityCommentForm,
                                       EntityProposalForm, ServiceSearchForm, ChartForm, SearchEntitiesForm)
 
 from met.metadataparser.summary_export import export_summary
 from met.metadataparser.query_export import export_query_set
 from met.metadataparser.entity_export import export_entity
-from met.metadataparser.xmlparser import DESCRIPTOR_TYPES
+from met.metadataparser.xmlparser import DESCRIPTOR_TYPES, pretty_print_xml
 from met.metadataparser.utils import send_mail
 
 if settings.PROFILE:
@@ -157,12 +158,6 @@ def _paginate_fed(ob_entities, page):
 
 @profile(name='Federation view')
 def federation_view(request, federation_slug=None):
-    if federation_slug:
-        request.session['%s_process_done' % federation_slug] = False
-        request.session['%s_num_entities' % federation_slug] = 0
-        request.session['%s_cur_entities' % federation_slug] = 0
-        request.session.save()
-
     federation = get_object_or_404(Federation, slug=federation_slug)
     if federation.registration_authority:
         categories = EntityCategory.objects.all().filter(
@@ -227,12 +222,14 @@ def federation_view(request, federation_slug=None):
 @user_can_edit(Federation)
 def federation_edit_post(request, federation, form):
     modify = True if federation else False
+    # Downloading the metadata could take long, the job does it instead
+    form.instance.defer_fetch = True
     form.save()
 
     if not modify:
         form.instance.editor_users.add(request.user)
     if 'file' in form.changed_data or 'file_url' in form.changed_data:
-        form.instance.process_metadata()
+        IngestJob.enqueue(form.instance, 'process_metadata')
 
     messages.success(request, _('Federation %s successfully' % 'modified' if modify else 'created'))
     return HttpResponseRedirect(form.instance.get_absolute_url() + '?update=true')
@@ -262,29 +259,35 @@ def federation_edit(request, federation_slug=None):
 @user_can_edit(Federation)
 def federation_update_entities(request, federation_slug=None):
     federation = get_object_or_404(Federation, slug=federation_slug)
-    federation.process_metadata_entities(request=request, federation_slug=federation_slug)
+    job = IngestJob.enqueue(federation, 'update_entities')
 
-    messages.success(request, _('Federation entities updated succesfully'))
-    return HttpResponse("Done. All entities updated.", content_type='text/plain')
+    return HttpResponse(json.dumps(job.to_dict()), content_type='application/javascript')
 
 
 def entityupdate_progress(request, federation_slug=None):
     data = { 'done': False }
     if federation_slug:
-        data = { 'done': request.session.get('%s_process_done' % federation_slug, False),
-                 'tot': request.session.get('%s_num_entities' % federation_slug, 0),
-                 'num': request.session.get('%s_cur_entities' % federation_slug, 0) }
+        federation = get_object_or_404(Federation, slug=federation_slug)
+        job = IngestJob.objects.filter(federation=federation).order_by('-created', '-id').first()
+        if job:
+            data = job.to_dict()
+        else:
+            # Entities updated by the refresh script
+            data = ProgressReporter.read(federation) or data
 
     return HttpResponse(json.dumps(data), content_type='application/javascript')
 
 
+def job_status(request, job_id):
+    job = get_object_or_404(IngestJob, id=job_id)
+    return HttpResponse(json.dumps(job.to_dict()), content_type='application/javascript')
+
+
 @user_can_edit(Federation, True)
 def federation_delete(request, federation_slug):
     federation = get_object_or_404(Federation, slug=federation_slug)
 
-    for entity in federation.entity_set.all():
-        if len(entity.federations.all()) == 1:
-            entity.delete()
+    federation.remove_entities(federation.entity_set.values_list('id', flat=True), delete_orphans=True)
 
     messages.success(request,
                      _(u"%(federation)s federation was deleted successfully"
@@ -470,7 +473,9 @@ def entity_view(request, entityid):
 
     if 'viewxml' in request.GET:
         serialized = entity.xml
-        response = HttpResponse(serialized, content_type='application/xml')
+        if serialized and 'pretty' in request.GET:
+            serialized = pretty_print_xml(serialized)
+        response = HttpResponse(serialized, content_type='application/xml; charset=utf-8')
         return response
 
     return render_to_response('metadataparser/entity_view.html',
@@ -10,8 +10,20 @@
 # Consortium GARR, http://www.garr.it
 #########################################################################################
 
+import os
+import mmap
+import itertools
+import multiprocessing
+from binascii import hexlify
+from collections import Mapping
+from contextlib import closing
+from cStringIO import StringIO
+
 from lxml import etree
 
+from met.metadataparser.compression import get_compression, open_metadata
+from met.metadataparser.entity_index import EntityIndex, load_index, standalone_fragment
+
 NAMESPACES = {
     'xml': 'http://www.w3.org/XML/1998/namespace',
     'xs': 'xs="http://www.w3.org/2001/XMLSchema',
@@ -58,26 +70,191 @@ def getlang(node):
 FEDERATION_ROOT_TAG = addns('EntitiesDescriptor')
 ENTITY_ROOT_TAG = addns('EntityDescriptor')
 
+ENTITY_CATEGORY_ATTRIBUTES = ('http://macedir.org/entity-category-support', 'http://macedir.org/entity-category')
+
+# Tags dispatched by the single walk of MetadataParser._walk_entity
+MDUI_LANG_FIELDS = {
+    addns('DisplayName', MDUI_NAMESPACE): 'displayName',
+    addns('Description', MDUI_NAMESPACE): 'description',
+    addns('InformationURL', MDUI_NAMESPACE): 'infoUrl',
+    addns('PrivacyStatementURL', MDUI_NAMESPACE): 'privacyUrl',
+}
+ORGANIZATION_FIELDS = {
+    addns('OrganizationName'): 'name',
+    addns('OrganizationDisplayName'): 'displayName',
+    addns('OrganizationURL'): 'URL',
+}
+CONTACT_FIELDS = {
+    addns('GivenName'): 'name',
+    addns('SurName'): 'surname',
+    addns('EmailAddress'): 'email',
+}
+DESCRIPTOR_TAGS = dict((addns(item), item) for item in DESCRIPTOR_TYPES)
+
+UIINFO_TAG = addns('UIInfo', MDUI_NAMESPACE)
+LOGO_TAG = addns('Logo', MDUI_NAMESPACE)
+ORGANIZATION_TAG = addns('Organization')
+CONTACT_TAG = addns('ContactPerson')
+EXTENSIONS_TAG = addns('Extensions')
+REGISTRATION_INFO_TAG = addns('RegistrationInfo', NAMESPACES['mdrpi'])
+REGISTRATION_POLICY_TAG = addns('RegistrationPolicy', NAMESPACES['mdrpi'])
+SCOPE_TAG = addns('Scope', NAMESPACES['shibmd'])
+ATTRIBUTE_CONSUMING_SERVICE_TAG = addns('AttributeConsumingService')
+REQUESTED_ATTRIBUTE_TAG = addns('RequestedAttribute')
+ENTITY_ATTRIBUTES_TAG = addns('EntityAttributes', NAMESPACES['mdattr'])
+ATTRIBUTE_TAG = addns('Attribute', NAMESPACES['saml'])
+ATTRIBUTE_VALUE_TAG = addns('AttributeValue', NAMESPACES['saml'])
+
+WALK_TAGS = [addns('DisplayName', MDUI_NAMESPACE), REGISTRATION_INFO_TAG, ATTRIBUTE_VALUE_TAG] + DESCRIPTOR_TAGS.keys()
+WALK_DETAILS_TAGS = (WALK_TAGS + MDUI_LANG_FIELDS.keys() + ORGANIZATION_FIELDS.keys() + CONTACT_FIELDS.keys() +
+                     [LOGO_TAG, REGISTRATION_POLICY_TAG, SCOPE_TAG, REQUESTED_ATTRIBUTE_TAG, CONTACT_TAG])
+WALK_TAGS = tuple(set(WALK_TAGS))
+WALK_DETAILS_TAGS = tuple(set(WALK_DETAILS_TAGS))
+
+
+def _ancestor_tags(node, root):
+    '''Return the tags of the ancestors of node below root, nearest first'''
+    tags = []
+    node = node.getparent()
+    while node is not None and node is not root:
+        tags.append(node.tag)
+        node = node.getparent()
+    return tags
+
+
+def _has_ancestors(node, root, *tags):
+    '''Tell if node has ancestors with the given tags, from the nearest to
+    the farthest, as in the XPath expression .//tags[-1]//...//tags[0]//node'''
+    pos = 0
+    for tag in _ancestor_tags(node, root):
+        if tag == tags[pos]:
+            pos += 1
+            if pos == len(tags):
+                return True
+    return False
+
+
+def pretty_print_xml(xml):
+    '''Return a serialized XML document indented'''
+    parser = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+    return etree.tostring(etree.fromstring(xml, parser), pretty_print=True)
+
+
+PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+PARALLEL_BATCH_SIZE = 200
+
+
+def _read_entity_element(stream, encoding, namespaces, entityid, offset, length):
+    '''Parse the EntityDescriptor stored at offset in stream on its own
+
+    Return None if the fragment is not the expected entity.
+    '''
+    stream.seek(offset)
+    fragment = stream.read(length)
+
+    # Wrap the fragment in an element declaring the namespaces it
+    # inherits from the enclosing EntitiesDescriptor.
+    fragment = '<?xml version="1.0" encoding="%s"?><fragment%s>%s</fragment>' % (encoding, namespaces, fragment)
+    parser = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+    try:
+        element = etree.fromstring(fragment, parser)[0]
+    except (etree.XMLSyntaxError, IndexError):
+        return None
+
+    if element.tag != ENTITY_ROOT_TAG or element.get('entityID') != entityid:
+        return None
+    return element
+
+
+# Document of a MetadataParser built from data, inherited by the pool
+# workers when they are forked
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _open_source(filename, data):
+    if data is not None:
+        return StringIO(data)
+    return open_metadata(filename)
+
+
+def _parse_entity_batch(task):
+    '''Extract the entities of a batch of byte ranges in a pool worker
+
+    Return None if any of them cannot be parsed on its own.
+    '''
+    filename, encoding, namespaces, ranges, details = task
+    entities = []
+    with closing(_open_source(filename, _worker_data)) as stream:
+        for entityid, offset, length in ranges:
+            element = _read_entity_element(stream, encoding, namespaces, entityid, offset, length)
+            if element is None:
+                return None
+            entities.append(MetadataParser._walk_entity(element, details))
+    return entities
 
-class MetadataParser(object):
-    def __init__(self, filename=None):
-        if filename is None:
-            raise ValueError('filename is required')
 
+class MetadataParser(object):
+    def __init__(self, filename=None, data=None, workers=1, parallel_min_size=PARALLEL_MIN_SIZE,
+                 content_digest=None):
+        '''Parse the metadata stored in filename or, if given, data
+
+        data is the document itself as a string, an mmap or a file object,
+        which is read at once. content_digest, the hex SHA-256 of the
+        document when known, is checked against the sidecar index.
+        '''
+        if filename is None and data is None:
+            raise ValueError('filename or data is required')
+
+        if data is not None and not isinstance(data, (str, mmap.mmap)):
+            data = data.read()
         self.filename = filename
-        context = etree.iterparse(self.filename, events=('start',), huge_tree=True, remove_blank_text=True)
+        self.data = data
+        self.compression = get_compression(filename) if data is None else None
+        self.workers = workers or multiprocessing.cpu_count()
+        self.parallel_min_size = parallel_min_size
+        self.content_digest = content_digest
+        context = etree.iterparse(self._open(), events=('start',), huge_tree=True, remove_blank_text=True)
         context = iter(context)
         _, self.rootelem = context.next()
         self.file_id = self.rootelem.get('ID', None)
         self.is_federation = self.rootelem.tag == FEDERATION_ROOT_TAG
         self.is_entity = not self.is_federation
+        self._index = None
+
+    def prepare_index(self):
+        '''Load the sidecar index of the file, building and storing it if needed'''
+        if self._index is None:
+            if self.data is None:
+                self._index = load_index(self.filename, self.content_digest)
+            else:
+                with closing(self._open()) as stream:
+                    self._index = EntityIndex.from_stream(stream)
+        return self._index
+
+    def _open(self):
+        '''Return a new stream over the metadata document'''
+        return _open_source(self.filename, self.data)
+
+    @property
+    def index(self):
+        '''Map every entityid in the file to its (offset, length, digest)'''
+        return self.prepare_index()
+
+    def _get_indexed_element(self, entityid):
+        offset, length, _ = self.index.get(entityid)
+        with closing(self._open()) as stream:
+            return _read_entity_element(stream, self.index.encoding, ''.join(self.index.namespaces.values()),
+                                        entityid, offset, length)
 
     @staticmethod
     def _get_entity_details(element):
         entity = {}
 
-        entity['xml'] = etree.tostring(element, pretty_print=True)
-
         entity['description'] = MetadataParser.entity_description(element)
         entity['infoUrl'] = MetadataParser.entity_information_url(element)
         entity['privacyUrl'] = MetadataParser.entity_privacy_url(element)
@@ -100,30 +277,160 @@ class MetadataParser(object):
         return languages
 
     @staticmethod
-    def _get_entity_by_id(context, entityid, details):
+    def _walk_entity(element, details):
+        '''Build the entity dictionary with a single walk of element
+
+        The result is the same as running every extractor below one after
+        the other (see _get_entity_by_xpath) but the subtree is traversed
+        only once, dispatching on the tag of the elements found.
+        '''
+        languages = dict((field, {}) for field in MDUI_LANG_FIELDS.values())
+        organization = {}
+        logos = []
+        scopes = []
+        attr_requested = {'required': [], 'optional': []}
+        contacts = []
+        contact_nodes = {}
+        reg_info = None
+        reg_policy = {}
+        categories = []
+        types = []
+        protocols = {}
+
+        for node in element.iter(*(WALK_DETAILS_TAGS if details else WALK_TAGS)):
+            tag = node.tag
+            if tag in DESCRIPTOR_TAGS:
+                if node.getparent() is element:
+                    types.append(DESCRIPTOR_TAGS[tag])
+                if 'protocolSupportEnumeration' in node.attrib:
+                    protocols.setdefault(DESCRIPTOR_TAGS[tag], node.attrib['protocolSupportEnumeration'])
+            elif tag in MDUI_LANG_FIELDS:
+                if _has_ancestors(node, element, UIINFO_TAG):
+                    languages[MDUI_LANG_FIELDS[tag]][getlang(node)] = node.text
+            elif tag == ATTRIBUTE_VALUE_TAG:
+                for ancestor in node.iterancestors(ATTRIBUTE_TAG):
+                    if (ancestor.get('Name') in ENTITY_CATEGORY_ATTRIBUTES and
+                            _has_ancestors(ancestor, element, ENTITY_ATTRIBUTES_TAG)):
+                        categories.append(node.text.strip())
+                        break
+            elif tag == REGISTRATION_INFO_TAG:
+                if reg_info is None and _has_ancestors(node, element, EXTENSIONS_TAG):
+                    reg_info = node
+            elif tag == REGISTRATION_POLICY_TAG:
+                lang = getlang(node)
+                if lang is not None and _has_ancestors(node, element, REGISTRATION_INFO_TAG, EXTENSIONS_TAG):
+                    reg_policy[lang] = node.text
+            elif tag in ORGANIZATION_FIELDS:
+                if node.getparent().tag == ORGANIZATION_TAG:
+                    lang_dict = organization.setdefault(getlang(node), {})
+                    lang_dict[ORGANIZATION_FIELDS[tag]] = node.text
+            elif tag == LOGO_TAG:
+                if node.text is not None and _has_ancestors(node, element, UIINFO_TAG):
+                    logos.append({
+                        'width': int(node.attrib.get('width', '0')),
+                        'height': int(node.attrib.get('height', '0')),
+                        'file': node.text,
+                        'lang': getlang(node),
+                    })
+            elif tag == SCOPE_TAG:
+                if node.text not in scopes and _has_ancestors(node, element, EXTENSIONS_TAG):
+                    scopes.append(node.text)
+            elif tag == REQUESTED_ATTRIBUTE_TAG:
+                if _has_ancestors(node, element, ATTRIBUTE_CONSUMING_SERVICE_TAG):
+                    index = 'required' if node.attrib.get('isRequired', 'false') == 'true' else 'optional'
+                    attr_requested[index].append([node.attrib.get('Name', None), node.attrib.get('FriendlyName', None)])
+            elif tag == CONTACT_TAG:
+                contact = {'type': node.attrib.get('contactType', ''), 'name': None, 'surname': None, 'email': None}
+                contact_nodes[node] = (contact, set())
+                contacts.append(contact)
+            elif tag in CONTACT_FIELDS:
+                # Keep the first matching descendant of every ContactPerson
+                for ancestor in node.iterancestors(CONTACT_TAG):
+                    if ancestor in contact_nodes:
+                        contact, seen = contact_nodes[ancestor]
+                        if tag not in seen:
+                            seen.add(tag)
+                            contact[CONTACT_FIELDS[tag]] = node.text
+
+        for lang_dict in languages.values() + [organization]:
+            lang_dict.pop(None, None)
+        if not types:
+            types = ['AASSODescriptor']
+
+        entity = {}
+        entity['entityid'] = element.attrib['entityID']
+        entity['file_id'] = element.get('ID', None)
+        entity['displayName'] = languages['displayName']
+        if reg_info is not None:
+            entity['registration_authority'] = reg_info.attrib.get('registrationAuthority')
+            entity['registration_instant'] = reg_info.attrib.get('registrationInstant')
+        entity['entity_categories'] = categories
+        entity['entity_types'] = types
+        if protocols.get(types[0]):
+            entity['protocols'] = protocols[types[0]].split(' ')
+        else:
+            entity['protocols'] = []
+
+        if details:
+            entity['description'] = languages['description']
+            entity['infoUrl'] = languages['infoUrl']
+            entity['privacyUrl'] = languages['privacyUrl']
+            entity['organization'] = organization
+            entity['logos'] = logos
+            entity['scopes'] = scopes
+            entity['attr_requested'] = attr_requested
+            entity['contacts'] = contacts
+            entity['registration_policy'] = reg_policy
+            entity = dict((k, v) for k, v in entity.iteritems() if v)
+
+        entity['languages'] = MetadataParser._entity_lang_seen(entity)
+        return entity
+
+    @staticmethod
+    def _get_entity(element, details):
+        return MetadataParser._walk_entity(element, details)
+
+    @staticmethod
+    def _get_entity_by_xpath(element, details):
+        # Reference implementation running every extractor on its own
+        entity = {}
+
+        entity['entityid'] = element.attrib['entityID']
+        entity['file_id'] = element.get('ID', None)
+        entity['displayName'] = MetadataParser.entity_displayname(element)
+        reg_info = MetadataParser.registration_information(element)
+        if reg_info and 'authority' in reg_info:
+           entity['registration_authority'] = reg_info['authority']
+        if reg_info and 'instant' in reg_info:
+           entity['registration_instant'] = reg_info['instant']
+        entity['entity_categories'] = MetadataParser.entity_categories(element)
+        entity['entity_types'] = MetadataParser.entity_types(element)
+        entity['protocols'] = MetadataParser.entity_protocols(element, entity['entity_types'])
+
+        if details:
+            entity_details = MetadataParser._get_entity_details(element)
+            entity.update(entity_details)
+            entity = dict((k, v) for k, v in entity.iteritems() if v)
+
+        entity['languages'] = MetadataParser._entity_lang_seen(entity)
+        return entity
+
+    @staticmethod
+    def _get_element_by_id(context, entityid):
         for _, element in context:
             if element.attrib['entityID'] == entityid:
-                entity = {}
-
-                entity['entityid'] = entityid
-                entity['file_id'] = element.get('ID', None)
-                entity['displayName'] = MetadataParser.entity_displayname(element)
-                reg_info = MetadataParser.registration_information(element)
-                if reg_info and 'authority' in reg_info:
-                   entity['registration_authority'] = reg_info['authority']
-                if reg_info and 'instant' in reg_info:
-                   entity['registration_instant'] = reg_info['instant']
-                entity['entity_categories'] = MetadataParser.entity_categories(element)
-                entity['entity_types'] = MetadataParser.entity_types(element)
-                entity['protocols'] = MetadataParser.entity_protocols(element, entity['entity_types'])
-
-                if details:
-                    entity_details = MetadataParser._get_entity_details(element)
-                    entity.update(entity_details)
-                    entity = dict((k, v) for k, v in entity.iteritems() if v)
-
-                entity['languages'] = MetadataParser._entity_lang_seen(entity)
-                yield entity
+                return element
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        return None
+
+    @staticmethod
+    def _get_all_entities(context, details, entityids=None):
+        for _, element in context:
+            if entityids is None or element.attrib['entityID'] in entityids:
+                yield MetadataParser._get_entity(element, details)
 
             element.clear()
             while element.getprevious() is not None:
@@ -139,18 +446,126 @@ class MetadataParser(object):
 
         return federation
 
+    def _get_element(self, entityid):
+        element = self._get_indexed_element(entityid)
+        if element is None:
+            # Fall back to a sequential scan if the index cannot be used
+            context = etree.iterparse(self._open(), tag=addns('EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
+            element = MetadataParser._get_element_by_id(context, entityid)
+            if element is None:
+                raise ValueError("Entity not found: %s" % entityid)
+        return element
+
     def get_entity(self, entityid, details=True):
-        context = etree.iterparse(self.filename, tag=addns('EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
-        element = None
-        for element in MetadataParser._get_entity_by_id(context, entityid, details):
-            return element
+        if entityid not in self.index:
+            raise ValueError("Entity not found: %s" % entityid)
+
+        element = self._get_element(entityid)
+        if details:
+            return LazyEntity(element, lambda: self.get_entity_xml(entityid))
+        return MetadataParser._get_entity(element, details)
+
+    def get_entity_xml(self, entityid, pretty=False):
+        '''Return the EntityDescriptor of entityid as found in the file,
+        encoded in UTF-8 and indented only if pretty is set'''
+        if entityid not in self.index:
+            raise ValueError("Entity not found: %s" % entityid)
+
+        offset, length, _ = self.index.get(entityid)
+        if self.data is not None:
+            fragment = self.data[offset:offset + length]
+        elif self.compression is None:
+            with open(self.filename, 'rb') as stream:
+                source = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    fragment = source[offset:offset + length]
+                finally:
+                    source.close()
+        else:
+            with closing(self._open()) as stream:
+                stream.seek(offset)
+                fragment = stream.read(length)
 
-        raise ValueError("Entity not found: %s" % entityid)
+        xml = standalone_fragment(fragment, self.index.namespaces)
+        if self.index.encoding.lower() not in ('utf-8', 'utf8'):
+            xml = xml.decode(self.index.encoding).encode('utf-8')
+        if pretty:
+            xml = pretty_print_xml(xml)
+        return xml
 
     def entity_exist(self, entityid):
-        entity_xpath = self.rootelem.xpath("//md:EntityDescriptor[@entityID='%s']"
-                                         % entityid, namespaces=NAMESPACES)
-        return len(entity_xpath) > 0
+        return entityid in self.index
+
+    def get_entity_digests(self):
+        '''Map every entityid to the sha1 hex digest of its EntityDescriptor'''
+        digests = {}
+        for entityid in self.index:
+            if entityid not in digests:
+                digests[entityid] = hexlify(self.index.get(entityid)[2])
+        return digests
+
+    def iter_entities(self, details=True, entityids=None):
+        # Yield the entities in document order, all of them or only those in
+        # entityids. Plain files are parsed with a pool of processes when
+        # there is enough to parse and selections are read from their byte
+        # ranges; anything else, and every compressed file, with a single
+        # streaming pass.
+        if entityids is not None:
+            entityids = frozenset(entityids)
+
+        if self.compression is None:
+            if entityids is None:
+                ranges = None
+                size = os.path.getsize(self.filename) if self.data is None else len(self.data)
+            else:
+                ranges = [entry for entry in self.index.ranges() if entry[0] in entityids]
+                size = sum(length for _, _, length in ranges)
+
+            # Daemonic processes, such as the parallel refresh workers,
+            # can not start a pool of their own
+            if self.workers > 1 and size >= self.parallel_min_size and not multiprocessing.current_process().daemon:
+                return self._iter_entities_parallel(details, ranges, entityids)
+            if ranges is not None:
+                return self._iter_indexed_entities(details, ranges)
+
+        context = etree.iterparse(self._open(), tag=addns('EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
+        return self._get_all_entities(context, details, entityids)
+
+    def _iter_indexed_entities(self, details, ranges):
+        namespaces = ''.join(self.index.namespaces.values())
+        with closing(self._open()) as stream:
+            for entityid, offset, length in ranges:
+                element = _read_entity_element(stream, self.index.encoding, namespaces, entityid, offset, length)
+                if element is None:
+                    element = self._get_element(entityid)
+                yield MetadataParser._get_entity(element, details)
+
+    def _iter_entities_parallel(self, details, ranges, entityids):
+        index = self.index
+        namespaces = ''.join(index.namespaces.values())
+        if ranges is None:
+            ranges = list(index.ranges())
+        tasks = [(self.filename, index.encoding, namespaces, ranges[pos:pos + PARALLEL_BATCH_SIZE], details)
+                 for pos in xrange(0, len(ranges), PARALLEL_BATCH_SIZE)]
+
+        pool = multiprocessing.Pool(max(1, min(self.workers, len(tasks))), _init_worker, (self.data,))
+        try:
+            parsed = 0
+            # imap hands the batches back in document order
+            for entities in pool.imap(_parse_entity_batch, tasks):
+                if entities is None:
+                    # Let the streaming parser go on with the rest of the file
+                    context = etree.iterparse(self._open(), tag=addns('EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
+                    for entity in itertools.islice(self._get_all_entities(context, details, entityids), parsed, None):
+                        yield entity
+                    return
+
+                for entity in entities:
+                    yield entity
+                parsed += len(entities)
+        finally:
+            pool.terminate()
+            pool.join()
 
     @staticmethod
     def _get_entities_id(context):
@@ -163,7 +578,7 @@ class MetadataParser(object):
 
     def get_entities(self):
         # Return entityid list
-        context = etree.iterparse(self.filename, tag=addns('EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
+        context = etree.iterparse(self._open(), tag=addns('EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
         return list(self._get_entities_id(context))
 
     @staticmethod
@@ -375,3 +790,69 @@ class MetadataParser(object):
                 email = None
             cont.append({ 'type': c_type, 'name': name, 'surname': surname, 'email': email })
         return cont
+
+
+# Extractors of the fields LazyEntity computes on first access
+LAZY_DETAIL_FIELDS = {
+    'description': MetadataParser.entity_description,
+    'infoUrl': MetadataParser.entity_information_url,
+    'privacyUrl': MetadataParser.entity_privacy_url,
+    'organization': MetadataParser.entity_organization,
+    'logos': MetadataParser.entity_logos,
+    'scopes': MetadataParser.entity_attribute_scope,
+    'attr_requested': MetadataParser.entity_requested_attributes,
+    'contacts': MetadataParser.entity_contacts,
+    'registration_policy': MetadataParser.registration_policy,
+}
+LAZY_LANGUAGE_FIELDS = ('description', 'infoUrl', 'privacyUrl', 'organization', 'displayName')
+
+
+class LazyEntity(Mapping):
+    '''Entity dictionary extracting the detail fields on first access
+
+    The summary fields are extracted at once, every detail field the first
+    time it is looked up. The xml field is the original EntityDescriptor
+    returned by xml_loader. As in the entities built with details, empty
+    fields are missing.
+    '''
+
+    def __init__(self, element, xml_loader):
+        self._element = element
+        self._xml_loader = xml_loader
+        self._fields = MetadataParser._walk_entity(element, False)
+        del self._fields['languages']
+
+    def _field(self, key):
+        if key not in self._fields:
+            if key == 'languages':
+                value = set()
+                for field in LAZY_LANGUAGE_FIELDS:
+                    if self._field(field):
+                        value |= set(self._field(field).keys())
+            elif key == 'xml':
+                value = self._xml_loader()
+            elif key in LAZY_DETAIL_FIELDS:
+                value = LAZY_DETAIL_FIELDS[key](self._element)
+            else:
+                return None
+            self._fields[key] = value
+        return self._fields[key]
+
+    def __getitem__(self, key):
+        value = self._field(key)
+        if not value and key != 'languages':
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        keys = set(self._fields) | set(LAZY_DETAIL_FIELDS)
+        keys.update(['xml', 'languages'])
+        for key in keys:
+            if key in self:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return dict(self)
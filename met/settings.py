@@ -280,3 +280,55 @@ STATS = {
     # Time format in the x axis
     'time_format': '%d/%m/%Y',
 }
+
+# Parallel parsing of metadata aggregates: number of worker processes
+# (None uses every core, 1 disables it) and the smallest file worth it
+METADATA_PARSER_WORKERS = None
+METADATA_PARSER_PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+
+# Compression of the fetched metadata files: None, 'gzip' or 'xz' (xz
+# needs the backports.lzma package). gzip files are stored in blocks of
+# 1MB, so showing an entity decompresses at most one block. xz files are
+# a single stream, so showing an entity decompresses the file up to it,
+# which is slow for large federations.
+METADATA_COMPRESSION = None
+
+# Progress of the entity updates, published every INGEST_PROGRESS_ENTITIES
+# entities or INGEST_PROGRESS_INTERVAL milliseconds. It is kept in the cache
+# when that is shared between processes (e.g. memcached), in the database
+# otherwise
+INGEST_PROGRESS_ENTITIES = 100
+INGEST_PROGRESS_INTERVAL = 1000
+
+# Entity updates with more entities than this are committed in batches of
+# this size, so that a refresh killed in the middle resumes from the last
+# committed batch (0 publishes every update in a single transaction)
+INGEST_CHECKPOINT_SIZE = 5000
+
+# Seconds to wait for each metadata source when refreshing a federation
+METADATA_FETCH_TIMEOUT = 60
+
+# Seconds after which a federation refreshed in parallel (--workers) is
+# reported as failed, also when its process was killed
+METADATA_REFRESH_TIMEOUT = 2 * 60 * 60
+
+# Times a metadata source is downloaded again after a connection error,
+# a timeout or a server error
+METADATA_FETCH_RETRIES = 2
+
+# Number of sources of a federation downloaded at the same time
+METADATA_FETCH_WORKERS = 4
+
+# Select the entities of downloaded metadata with the built-in streaming
+# pipeline. pyff is still used for the sources that are not local files
+METADATA_NATIVE_PIPELINE = True
+
+# Directory of MEDIA_ROOT where fetched metadata is stored by its SHA-256,
+# shared by the federations fetching the same document
+METADATA_BLOB_DIRECTORY = 'metadata/blobs'
+
+# Seconds between the heartbeats of a running ingest job, and seconds
+# without any after which the job is considered abandoned by its worker
+# and queued again
+INGEST_JOB_HEARTBEAT = 60
+INGEST_JOB_TIMEOUT = 10 * 60